@@ -1,9 +1,13 @@
-from flask import Blueprint, make_response, request, jsonify, \
+from flask import Blueprint, make_response, request, jsonify, current_app, \
     session as flask_session
-from geomancer.worker import DelayedResult, do_the_work
-from geomancer.helpers import import_class, get_geo_types, get_data_sources
-from geomancer.app_config import MANCERS, MANCER_KEYS
+from geomancer.worker import DelayedResult, do_the_work, choose_queue, \
+    cached_result
+from geomancer.helpers import get_geo_types, get_data_sources, \
+    registry as mancer_registry
 from geomancer.mancers.geotype import GeoTypeEncoder
+from geomancer.progress import get_progress
+from geomancer.cancellation import request_cancel
+from geomancer import blob_store
 import json
 from redis import Redis
 from collections import OrderedDict
@@ -52,12 +56,20 @@ def geomance_api():
 
     field_defs = json.loads(request.data)
     if request.files:
-        file_contents = request.files['input_file'].read()
+        file_ref = blob_store.store(request.files['input_file'])
         filename = request.files['input_file'].filename
     else:
-        file_contents = flask_session['file']
+        file_ref = blob_store.session_file(flask_session)
         filename = flask_session['filename']
-    session = do_the_work.delay(file_contents, field_defs, filename)
+    cached = cached_result(file_ref, field_defs, filename)
+    if cached is not None:
+        session = DelayedResult.finished({'status': 'ok', 'result': cached})
+    else:
+        num_columns = sum([len(d['append_columns']) for d in field_defs.values()])
+        queue = choose_queue(current_app.config,
+                             blob_store.count_rows(file_ref), num_columns)
+        session = do_the_work.enqueue(args=(file_ref, field_defs, filename),
+                                      queue=queue, session_id=flask_session.sid)
     resp = make_response(json.dumps({'session_key': session.key}))
     resp.headers['Content-Type'] = 'application/json'
     return resp
@@ -74,6 +86,45 @@ def geomance_results(session_key):
     result = rv.return_value
     return jsonify(ready=True, result=result['result'], status=result['status'])
 
+@api.route('/api/geomance-progress/<session_key>/')
+def geomance_progress(session_key):
+    """ 
+    Reports how far along a job is. While it runs the worker publishes the
+    current stage ('scanning', 'lookup', 'search', 'writing'), the rows
+    scanned, geographies resolved, searches done and an ETA in seconds for
+    the current stage. Before a worker picks the job up the stage is
+    'queued'.
+    """
+    progress = get_progress(redis, session_key)
+    if progress is None:
+        if redis.exists(session_key):
+            progress = {'stage': 'done'}
+        else:
+            progress = {'stage': 'queued'}
+    return jsonify(**progress)
+
+@api.route('/api/geomance-cancel/<session_key>/', methods=['POST'])
+def geomance_cancel(session_key):
+    """ 
+    Stops a job. A queued job is skipped when a worker gets to it and a
+    running one stops at its next check, within a second or so. Either way
+    its result has the status 'cancelled'.
+
+    Any request body is ignored, so navigator.sendBeacon() can be used from
+    a page that's going away.
+    """
+    prefix = '%s:result:' % current_app.config['REDIS_QUEUE_KEY']
+    if not session_key.startswith(prefix):
+        resp = make_response(json.dumps({
+            'status': 'error',
+            'message': '%s is not a job' % session_key,
+        }), 404)
+    else:
+        request_cancel(redis, session_key)
+        resp = make_response(json.dumps({'status': 'ok'}))
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
 @api.route('/api/data-sources/')
 def data_sources():
     """ 
@@ -94,14 +145,8 @@ def table_info():
     Return a list of data sources
     """
     columns = OrderedDict()
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            continue
-        col_info = m.get_metadata()
+    mancers, errors = mancer_registry.mancers()
+    for m, col_info in mancers:
         for col in col_info:
             columns[col['table_id']] = {
               'table_id': col['table_id'],
@@ -0,0 +1,138 @@
+import os
+import re
+import gzip
+import time
+import hashlib
+from tempfile import NamedTemporaryFile
+from cStringIO import StringIO
+from os.path import join, abspath, dirname
+
+try:
+    from geomancer.app_config import UPLOAD_FOLDER
+except ImportError:
+    UPLOAD_FOLDER = abspath(join(dirname(__file__), 'upload_folder'))
+
+try:
+    from geomancer.app_config import COMPRESS_UPLOADS
+except ImportError:
+    COMPRESS_UPLOADS = True
+
+try:
+    from geomancer.app_config import UPLOAD_TTL
+except ImportError:
+    UPLOAD_TTL = 60 * 60 * 24 # same as the session lifetime
+
+CHUNK_SIZE = 64 * 1024
+REF_REGEX = re.compile(r'^[0-9a-f]{40}$')
+
+class BlobNotFound(Exception):
+    pass
+
+def _path(ref):
+    if not REF_REGEX.match(ref or ''):
+        raise BlobNotFound('"%s" is not a valid file reference' % ref)
+    return join(UPLOAD_FOLDER, ref)
+
+def store(f):
+    """
+    Copy the contents of the file-like object 'f' into the store and return
+    a reference to it. The reference is the SHA1 of the contents, so storing
+    the same upload twice only keeps one copy. Only the reference needs to
+    go through Redis; the web app and the worker read the contents from disk.
+    """
+    if not os.path.isdir(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+    sha = hashlib.sha1()
+    tmp = NamedTemporaryFile(dir=UPLOAD_FOLDER, prefix='.', delete=False)
+    try:
+        if COMPRESS_UPLOADS:
+            # Favour speed over size, CSV compresses well either way
+            out = gzip.GzipFile(fileobj=tmp, mode='wb', compresslevel=1)
+        else:
+            out = tmp
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            sha.update(chunk)
+            out.write(chunk)
+        out.close()
+        tmp.close()
+        ref = sha.hexdigest()
+        path = _path(ref)
+        if os.path.exists(path):
+            os.remove(tmp.name)
+            # Keep a reused upload from being pruned
+            os.utime(path, None)
+        else:
+            os.chmod(tmp.name, 0644)
+            os.rename(tmp.name, path)
+    except:
+        tmp.close()
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+    return ref
+
+def open_blob(ref):
+    """
+    Open a stored upload for reading. Returns a file-like object with the
+    original (uncompressed) contents.
+    """
+    path = _path(ref)
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        raise BlobNotFound('Uploaded file %s could not be found' % ref)
+    if f.read(2) == '\x1f\x8b':
+        f.seek(0)
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    f.seek(0)
+    return f
+
+def session_file(session):
+    """
+    The reference to the upload in session['file']. Sessions from before
+    uploads went in the store hold the file itself; it's stored now and the
+    session rewritten to refer to it, the way worker.decode_job does for
+    queued jobs.
+    """
+    value = session['file']
+    if not REF_REGEX.match(value):
+        value = session['file'] = store(StringIO(value))
+    return value
+
+def count_rows(ref):
+    """
+    Quick estimate of the number of data rows in a stored CSV (line count
+    less the header) without parsing it.
+    """
+    f = open_blob(ref)
+    try:
+        lines = 0
+        last = ''
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            lines += chunk.count('\n')
+            last = chunk
+        if last and not last.endswith('\n'):
+            lines += 1
+    finally:
+        f.close()
+    return max(lines - 1, 0)
+
+def prune(max_age=UPLOAD_TTL):
+    """
+    Remove uploads that haven't been stored or reused for 'max_age' seconds.
+    Returns the number of files removed.
+    """
+    if not os.path.isdir(UPLOAD_FOLDER):
+        return 0
+    cutoff = time.time() - max_age
+    count = 0
+    for fname in os.listdir(UPLOAD_FOLDER):
+        path = join(UPLOAD_FOLDER, fname)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                count += 1
+        except OSError:
+            # Someone else got to it first
+            continue
+    return count
@@ -0,0 +1,70 @@
+import time
+from threading import Lock
+
+# Least number of seconds between checks of Redis for a cancel request
+CHECK_INTERVAL = 1
+# Seconds a cancel request is kept, long enough for a queued job to come up
+CANCEL_TTL = 60 * 60 * 24
+
+class JobCancelled(Exception):
+    pass
+
+class JobTimedOut(JobCancelled):
+    pass
+
+def cancel_key(result_key):
+    return '%s:cancel' % result_key
+
+def request_cancel(redis, result_key):
+    """
+    Ask the worker running (or about to run) the job that writes its result
+    to 'result_key' to give up on it.
+    """
+    redis.set(cancel_key(result_key), time.time())
+    redis.expire(cancel_key(result_key), CANCEL_TTL)
+
+class JobControl(object):
+    """
+    Lets a running job find out whether it has been cancelled or has run
+    past its deadline (a unix timestamp). check() raises JobCancelled (or
+    JobTimedOut) if so; the job functions and mancers call it between
+    stages, between chunks of rows and before each HTTP request. The
+    cancel flag is read from Redis at most every CHECK_INTERVAL seconds.
+
+    With no redis connection or key only the deadline is checked, and with
+    neither check() never raises.
+    """
+
+    def __init__(self, redis=None, result_key=None, deadline=None):
+        self.redis = redis
+        self.key = cancel_key(result_key) if result_key else None
+        self.deadline = deadline
+        self.cancelled = False
+        self._checked = 0
+        self._lock = Lock()
+
+    def time_left(self):
+        """
+        Seconds until the deadline, or None if there isn't one.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def check(self):
+        left = self.time_left()
+        if left is not None and left <= 0:
+            raise JobTimedOut('This job ran out of time and was stopped')
+        if self.redis is None or self.key is None:
+            return
+        with self._lock:
+            if not self.cancelled and \
+                    time.time() - self._checked >= CHECK_INTERVAL:
+                self._checked = time.time()
+                self.cancelled = bool(self.redis.exists(self.key))
+        if self.cancelled:
+            raise JobCancelled('This job was cancelled')
+
+# Control for the job this process is working on. queue_daemon swaps in one
+# for each job; this one never stops anything.
+current = JobControl()
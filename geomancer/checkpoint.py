@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import shutil
+from hashlib import sha1
+from threading import Lock
+from tempfile import NamedTemporaryFile
+from os.path import join, abspath, dirname
+
+try:
+    from geomancer.app_config import CHECKPOINT_FOLDER
+except ImportError:
+    CHECKPOINT_FOLDER = abspath(join(dirname(__file__), 'checkpoint_folder'))
+
+try:
+    from geomancer.app_config import CHECKPOINT_TTL
+except ImportError:
+    CHECKPOINT_TTL = 60 * 60 * 24 * 2 # seconds
+
+# Least number of seconds between updates of a checkpoint's modification
+# time while it's in use
+TOUCH_INTERVAL = 60
+
+class Checkpoint(object):
+    """
+    Saves what a job has finished so far to local disk, so that when the
+    same job runs again (requeued after its worker died, retried after an
+    error or resubmitted after being cancelled) it picks up where the last
+    attempt left off rather than starting over.
+
+    'job_id' identifies the work, not the attempt: identical jobs share a
+    checkpoint. Two things are kept under <CHECKPOINT_FOLDER>/<job_id>/:
+
+      lookup-<mancer>.jsonl  one [term, geoid] line per geography resolved,
+                             appended as the lookups come back
+      search-<hash>.json     the result of mancer.search for one column
+
+    clear() removes it all once the job has succeeded.
+    """
+
+    def __init__(self, job_id, folder=CHECKPOINT_FOLDER):
+        self.path = join(folder, job_id)
+        self._lookup_files = {}
+        self._lock = Lock()
+        self._touched = 0
+
+    def _ensure_path(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Made by another thread in the meantime
+                if not os.path.isdir(self.path):
+                    raise
+
+    def _touch(self):
+        """
+        Mark the checkpoint as in use. prune goes by the directory's
+        modification time, which appending to a file in it doesn't change.
+        """
+        now = time.time()
+        if now - self._touched < TOUCH_INTERVAL:
+            return
+        try:
+            os.utime(self.path, None)
+        except OSError:
+            return
+        self._touched = now
+
+    def _lookup_path(self, name):
+        return join(self.path, 'lookup-%s.jsonl' % name)
+
+    def _search_path(self, column):
+        return join(self.path, 'search-%s.json' % \
+                    sha1(column.encode('utf-8')).hexdigest())
+
+    def lookups(self, name):
+        """
+        Geoids already resolved by the mancer called 'name', as a dict of
+        term -> geoid (None where nothing matched).
+        """
+        saved = {}
+        try:
+            f = open(self._lookup_path(name), 'rb')
+        except IOError:
+            return saved
+        self._touch()
+        with f:
+            for line in f:
+                try:
+                    term, geoid = json.loads(line)
+                except ValueError:
+                    # Half written when the last attempt died
+                    continue
+                saved[term] = geoid
+        return saved
+
+    def save_lookup(self, name, term, geoid):
+        with self._lock:
+            f = self._lookup_files.get(name)
+            if f is None:
+                self._ensure_path()
+                f = open(self._lookup_path(name), 'ab')
+                # Start on a fresh line if the last attempt died mid-write
+                if f.tell() > 0:
+                    f.write('\n')
+                self._lookup_files[name] = f
+            f.write(json.dumps([term, geoid]) + '\n')
+            f.flush()
+            self._touch()
+
+    def search_result(self, column):
+        """
+        The saved search result for 'column', or None.
+        """
+        try:
+            with open(self._search_path(column), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save_search_result(self, column, data):
+        self._ensure_path()
+        tmp = NamedTemporaryFile(dir=self.path, prefix='.', delete=False)
+        try:
+            json.dump(data, tmp)
+            tmp.close()
+            os.rename(tmp.name, self._search_path(column))
+            self._touch()
+        except:
+            tmp.close()
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+            raise
+
+    def close(self):
+        with self._lock:
+            for f in self._lookup_files.values():
+                f.close()
+            self._lookup_files = {}
+
+    def clear(self):
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def prune(max_age=CHECKPOINT_TTL, folder=CHECKPOINT_FOLDER):
+    """
+    Remove checkpoints of jobs that haven't been touched for 'max_age'
+    seconds. Returns the number removed.
+    """
+    if not os.path.isdir(folder):
+        return 0
+    cutoff = time.time() - max_age
+    count = 0
+    for name in os.listdir(folder):
+        path = join(folder, name)
+        try:
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path)
+                count += 1
+        except OSError:
+            # Someone else got to it first
+            continue
+    return count
@@ -1,8 +1,15 @@
 from geomancer.app_config import MANCERS, MANCER_KEYS
 from collections import OrderedDict
+from threading import Thread, Lock
 import operator
+import time
 import re
 
+try:
+    from geomancer.app_config import MANCER_METADATA_TTL
+except ImportError:
+    MANCER_METADATA_TTL = 60 * 60 # seconds
+
 from geomancer.mancers.geotype import County
 
 GEOTYPES = [
@@ -25,23 +32,110 @@ def import_class(cl):
     m = __import__(cl[0:d], globals(), locals(), [classname])
     return getattr(m, classname)
 
+class MancerRegistry(object):
+    """
+    Process-wide set of the mancers in MANCERS, instantiated once along with
+    their metadata and a table_id -> mancer routing table. Fetching metadata
+    can mean a dozen HTTP requests per mancer, so it's done on first use and
+    then refreshed in a background thread every 'ttl' seconds. Callers keep
+    getting the previous snapshot while a refresh runs, and if it fails.
+
+    Threads don't survive a fork, so a forked worker should build its own
+    snapshot (registry.get()) after it starts rather than inherit one.
+    """
+
+    def __init__(self, mancers=MANCERS, ttl=MANCER_METADATA_TTL):
+        self.mancer_paths = mancers
+        self.ttl = ttl
+        self._snapshot = None
+        self._built = 0
+        self._refreshing = False
+        self._lock = Lock()
+
+    def _build(self):
+        snapshot = {
+            'mancers': [],
+            'metadata': OrderedDict(),
+            'routes': {},
+            'errors': [],
+        }
+        for mancer in self.mancer_paths:
+            m = import_class(mancer)
+            api_key = MANCER_KEYS.get(m.machine_name)
+            try:
+                m = m(api_key=api_key)
+            except ImportError, e:
+                snapshot['errors'].append(e.message)
+                continue
+            metadata = m.get_metadata()
+            snapshot['mancers'].append(m)
+            snapshot['metadata'][m.machine_name] = metadata
+            for col in metadata:
+                # Later mancers win if two offer the same table
+                snapshot['routes'][col['table_id']] = m
+        return snapshot
+
+    def _refresh(self):
+        try:
+            snapshot = self._build()
+        except Exception, e:
+            print 'Refreshing mancer metadata failed: %s' % e
+            snapshot = None
+        with self._lock:
+            if snapshot is not None:
+                self._snapshot = snapshot
+            # Don't retry a failed refresh straight away either
+            self._built = time.time()
+            self._refreshing = False
+
+    def get(self):
+        """
+        The current snapshot, a dict with the instantiated 'mancers', their
+        'metadata' keyed by machine name, the 'routes' from table_id to
+        mancer and the 'errors' from mancers that couldn't be set up.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._build()
+                self._built = time.time()
+            elif not self._refreshing and time.time() - self._built > self.ttl:
+                self._refreshing = True
+                refresh = Thread(target=self._refresh)
+                refresh.daemon = True
+                refresh.start()
+            return self._snapshot
+
+    def reset(self):
+        with self._lock:
+            self._snapshot = None
+
+    def mancers(self):
+        """
+        (mancer, metadata) pairs in the order of MANCERS, plus the errors.
+        """
+        snapshot = self.get()
+        return [(m, snapshot['metadata'][m.machine_name]) \
+                for m in snapshot['mancers']], snapshot['errors']
+
+    def route(self, table_id):
+        """
+        The mancer that serves 'table_id', or None.
+        """
+        return self.get()['routes'].get(table_id)
+
+registry = MancerRegistry()
+
 def get_geo_types(geo_type=None):
     types = {}
     columns = []
     geo_types = []
-    errors = []
 
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            errors.append(e.message)
-            continue
-        for col in m.get_metadata():
+    mancers, errors = registry.mancers()
+    errors = list(errors)
+    for m, metadata in mancers:
+        for col in metadata:
             geo_types.extend(col['geo_types'])
-        columns.extend(m.get_metadata())
+        columns.extend(metadata)
     for t in geo_types:
         types[t.machine_name] = {}
         types[t.machine_name]['info'] = t
@@ -86,15 +180,9 @@ def guess_geotype(header, values):
 
 def get_data_sources(geo_type=None):
     mancer_data = []
-    errors = []
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            errors.append(e.message)
-            continue
+    mancers, errors = registry.mancers()
+    errors = list(errors)
+    for m, info in mancers:
         mancer_obj = {
             "name": m.name, 
             "machine_name": m.machine_name, 
@@ -103,14 +191,13 @@ def get_data_sources(geo_type=None):
             "description": m.description, 
             "data_types": {}
         }
-        info = m.get_metadata()
         for col in info:
             if geo_type:
                 col_types = [i.machine_name for i in col['geo_types']]
                 if geo_type in col_types:
-                    mancer_obj["data_types"][col['table_id']] = col
+                    mancer_obj["data_types"][col['table_id']] = dict(col)
             else:
-                mancer_obj["data_types"][col['table_id']] = col
+                mancer_obj["data_types"][col['table_id']] = dict(col)
             try:
                 mancer_obj["data_types"][col['table_id']]['geo_types'] = \
                     sorted(mancer_obj["data_types"][col['table_id']]['geo_types'], 
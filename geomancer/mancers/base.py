@@ -1,19 +1,133 @@
 import scrapelib
+import requests
+import time
 from urllib import urlencode
 import json
 import os
 from geomancer.app_config import CACHE_DIR
 from geomancer.helpers import encoded_dict
+from geomancer.mancers.cache import cache_storage, CACHE_SOFT_TTL
+from geomancer import cancellation
+from geomancer.mancers.rate_limit import rate_limiter
+from geomancer.mancers.coalesce import coalescer
+from geomancer.mancers.circuit_breaker import circuit_breaker
+from geomancer.metrics import MANCER_REQUESTS, MANCER_REQUEST_SECONDS, \
+    MANCER_CACHE, MANCER_RATE_LIMIT_WAIT, MANCER_COALESCED
 from string import punctuation
+from threading import Lock, Thread, local
+from Queue import Queue, Full
+from requests.adapters import HTTPAdapter
 import re
 from urlparse import urlparse
 
+# Most connections kept open to any one upstream host. Should be at least
+# the number of threads a job makes requests from.
+try:
+    from geomancer.app_config import HTTP_POOL_SIZE
+except ImportError:
+    HTTP_POOL_SIZE = 16
+
+# Seconds to wait on an upstream API to connect or send data
+try:
+    from geomancer.app_config import HTTP_TIMEOUT
+except ImportError:
+    HTTP_TIMEOUT = 60
+
+# Upstream hosts connection pools are kept for
+HTTP_POOL_HOSTS = 20
+
+# Threads refreshing stale responses in the background in each process, and
+# most refreshes waiting for them. Stale responses found while the queue is
+# full aren't refreshed this time round.
+REFRESH_THREADS = 2
+REFRESH_QUEUE_SIZE = 1000
+
+_adapter = None
+_adapter_pid = None
+_adapter_lock = Lock()
+
+# Cache keys of stale responses being refreshed in the background
+_refreshing = set()
+_refreshing_lock = Lock()
+# Set in the threads doing the refreshing, so they skip the cached response
+_revalidating = local()
+# What those threads check instead of the job's JobControl: never stops
+_no_job = cancellation.JobControl()
+# Refreshes waiting for one of those threads, and the process they run in
+_refreshes = None
+_refreshes_pid = None
+
+def _refresh_worker(refreshes):
+    _revalidating.active = True
+    while True:
+        mancer, key, method, url, kwargs = refreshes.get()
+        try:
+            mancer._request(method, url, **kwargs)
+        except Exception, e:
+            print 'Refreshing %s failed: %s' % (url, e)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+def refresh_queue():
+    """
+    The queue of background refreshes for this process, with its
+    REFRESH_THREADS threads. A forked process starts its own.
+    """
+    global _refreshes, _refreshes_pid
+    with _refreshing_lock:
+        if _refreshes is None or _refreshes_pid != os.getpid():
+            _refreshes = Queue(REFRESH_QUEUE_SIZE)
+            _refreshes_pid = os.getpid()
+            _refreshing.clear()
+            for i in range(REFRESH_THREADS):
+                thread = Thread(target=_refresh_worker, args=(_refreshes,))
+                thread.daemon = True
+                thread.start()
+        return _refreshes
+
+def http_adapter():
+    """
+    The connection pools shared by every mancer in the process, so the
+    connections (and TLS sessions) to each upstream host are kept alive and
+    reused by all mancer instances and threads. A forked process gets its
+    own rather than sharing the parent's sockets.
+    """
+    global _adapter, _adapter_pid
+    with _adapter_lock:
+        if _adapter is None or _adapter_pid != os.getpid():
+            _adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS,
+                                   pool_maxsize=HTTP_POOL_SIZE)
+            _adapter_pid = os.getpid()
+        return _adapter
+
 class MancerError(Exception):
     def __init__(self, message, body=None):
         Exception.__init__(self, message)
         self.message = message
         self.body = body
 
+class UpstreamUnavailable(MancerError):
+    """
+    The mancer's upstream API can't be reached at the moment. The worker
+    finishes a job without the mancer when it gets one of these.
+    """
+    pass
+
+class UpstreamConnectionError(UpstreamUnavailable, requests.ConnectionError):
+    """
+    A connection error or timeout talking to the upstream API. It's also a
+    requests.ConnectionError so scrapelib still retries it.
+    """
+    pass
+
+class CircuitOpenError(UpstreamUnavailable):
+    """
+    Raised instead of making a request to a host that has been failing,
+    see geomancer.mancers.circuit_breaker.
+    """
+    pass
+
 class BaseMancer(scrapelib.Scraper):
     """ 
     Subclassing scrapelib here mainly to take advantage of pluggable caching backend.
@@ -23,6 +137,20 @@ class BaseMancer(scrapelib.Scraper):
     base_url = None     # base url for the api
     info_url = None     # this will show up next to the name on the /select-tables page
     description = None  # this will show up under the name on the /select-tables page
+    cache_ttl = None    # seconds this mancer's responses are cached for, None for CACHE_TTL
+    cache_soft_ttl = None # seconds before a cached response is refreshed in the background, None for CACHE_SOFT_TTL
+    vintage = None      # release of the data this serves (e.g. 'acs2013_5yr'), None if it's always live.
+                        # Change it when the upstream data is updated so stale results aren't reused.
+    previous_vintage = None # the vintage before that. Until a response for the new vintage is cached,
+                            # the previous one's is served as stale and refreshed in the background.
+
+    # (requests per second, burst) allowed to this mancer's API across all
+    # workers, or None for no limit. RATE_LIMITS in app_config overrides it.
+    rate_limit = None
+
+    # Number of geo_lookup_many batches the worker may run at the same time.
+    # Mancers that resolve geographies through a remote API should raise this.
+    lookup_concurrency = 1
 
     # If True, geomancer will check that an API key is passed into the constructor.
     # If it's not present, the mancer will be disabled and an error will display.
@@ -42,12 +170,16 @@ class BaseMancer(scrapelib.Scraper):
                                              retry_attempts=retry_attempts,
                                              retry_wait_seconds=retry_wait_seconds,
                                              header_func=header_func)
+        self.timeout = HTTP_TIMEOUT
+        self.mount('http://', http_adapter())
+        self.mount('https://', http_adapter())
         
-        # We might want to talk about configuring an S3 backed cache for this
-        # so we don't run the risk of running out of disk space.
+        # The storage is picked with CACHE_BACKEND in app_config, see
+        # geomancer.mancers.cache
         self.cache_dir = cache_dir
-        self.cache_storage = scrapelib.cache.FileCache(self.cache_dir)
+        self.cache_storage = cache_storage(self.cache_dir, ttl=self.cache_ttl)
         self.cache_write_only = False
+        self.rate_limiter = rate_limiter(self)
         
         # If subclass declares that an API Key is required and an API Key is not given, 
         # raise an ImportError
@@ -55,14 +187,174 @@ class BaseMancer(scrapelib.Scraper):
             raise ImportError('The %s mancer requires an API key and is disabled.' % self.name)
 
 
+    def request(self, method, url, **kwargs):
+        """
+        Wraps scrapelib's request to count cache hits and misses and time the
+        requests that actually go out to the upstream API.
+
+        Identical GETs made at the same time share one request, see
+        geomancer.mancers.coalesce.
+        """
+        # Don't start on requests for a job that's been cancelled or is out
+        # of time, and don't let one outlive the job's deadline
+        control = self._control()
+        control.check()
+        time_left = control.time_left()
+        requested = dict(kwargs)
+        if time_left is not None:
+            kwargs['timeout'] = min(kwargs.get('timeout') or self.timeout \
+                                    or time_left, time_left)
+        key = self.key_for_request(method.lower(), url, **kwargs)
+        if key is None or self.cache_write_only:
+            return self._request(method, url, **kwargs)
+        if self.previous_vintage and self.cache_storage:
+            resp = self._from_previous_vintage(key, method, url, requested)
+            if resp is not None:
+                return resp
+        resp, coalesced = coalescer.fetch(key,
+            lambda: self._request(method, url, **kwargs),
+            shared=bool(self.cache_storage))
+        if coalesced:
+            MANCER_COALESCED.inc(mancer=self.machine_name)
+        if getattr(resp, 'fromcache', False) and self._is_stale(resp):
+            # Without the timeout capped to this job's deadline
+            self._revalidate(key, method, url, requested)
+        return resp
+
+    def key_for_request(self, method, url, **kwargs):
+        """
+        Responses are cached under their URL tagged with the mancer's
+        vintage, so bumping the vintage moves the mancer on to new entries
+        all at once and the old ones are left to expire rather than being
+        flushed.
+        """
+        key = super(BaseMancer, self).key_for_request(method, url, **kwargs)
+        if key is None or not self.vintage:
+            return key
+        return '%s#vintage=%s' % (key, self.vintage)
+
+    def _control(self):
+        """
+        The JobControl requests are checked against. Refreshes of stale
+        responses run outside of any job, so the job that happened to find
+        the response stale can't cancel them or cut them short.
+        """
+        if getattr(_revalidating, 'active', False):
+            return _no_job
+        return cancellation.current
+
+    def _from_previous_vintage(self, key, method, url, kwargs):
+        """
+        When nothing is cached for 'key' yet, the response cached for the
+        same request under previous_vintage, if any. Its refresh puts the
+        current vintage's response under 'key'.
+        """
+        if self.cache_storage.get(key) is not None:
+            return None
+        old_key = super(BaseMancer, self).key_for_request(method.lower(), url,
+                                                          **kwargs)
+        resp = self.cache_storage.get('%s#vintage=%s' % (old_key,
+                                                         self.previous_vintage))
+        if resp is None:
+            return None
+        resp.fromcache = True
+        self._revalidate(key, method, url, kwargs)
+        return resp
+
+    @property
+    def cache_write_only(self):
+        return self._cache_write_only or getattr(_revalidating, 'active', False)
+
+    @cache_write_only.setter
+    def cache_write_only(self, value):
+        self._cache_write_only = value
+
+    def _is_stale(self, resp):
+        soft_ttl = self.cache_soft_ttl
+        if soft_ttl is None:
+            soft_ttl = CACHE_SOFT_TTL
+        cached_at = getattr(resp, 'cached_at', None)
+        if soft_ttl is None or cached_at is None:
+            return False
+        return time.time() - cached_at > soft_ttl
+
+    def _revalidate(self, key, method, url, kwargs):
+        """
+        Queue a stale response to be fetched again in the background and put
+        in the cache, while callers carry on with the stale one. A response
+        is only refreshed by one thread at a time.
+        """
+        refreshes = refresh_queue()
+        with _refreshing_lock:
+            if key in _refreshing:
+                return
+            _refreshing.add(key)
+        MANCER_CACHE.inc(mancer=self.machine_name, result='stale')
+        try:
+            refreshes.put_nowait((self, key, method, url, kwargs))
+        except Full:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+            MANCER_CACHE.inc(mancer=self.machine_name, result='refresh_dropped')
+
+    def _request(self, method, url, **kwargs):
+        start = time.time()
+        try:
+            resp = super(BaseMancer, self).request(method, url, **kwargs)
+        except scrapelib.HTTPError, e:
+            self._record_request(method, e.response, start)
+            raise
+        except requests.RequestException:
+            MANCER_REQUESTS.inc(mancer=self.machine_name, code='error')
+            MANCER_REQUEST_SECONDS.observe(time.time() - start,
+                                           mancer=self.machine_name)
+            raise
+        self._record_request(method, resp, start)
+        return resp
+
+    def send(self, request, **kwargs):
+        """
+        Everything that actually goes out to the API, including retries but
+        not cache hits, waits its turn under the mancer's rate limit. It's
+        turned down with a CircuitOpenError while the host is failing, which
+        also cuts short scrapelib's retries. Connection errors and timeouts
+        are raised as UpstreamConnectionError.
+        """
+        host = urlparse(request.url).netloc
+        breaker = circuit_breaker(self.machine_name, host)
+        if not breaker.allow():
+            raise CircuitOpenError('%s is not responding, so %s is '
+                                   'unavailable for now' % (host, self.name))
+        ok = None
+        try:
+            if self.rate_limiter is not None:
+                waited = self.rate_limiter.wait(host, self._control(),
+                    background=getattr(_revalidating, 'active', False))
+                MANCER_RATE_LIMIT_WAIT.observe(waited, mancer=self.machine_name)
+            resp = super(BaseMancer, self).send(request, **kwargs)
+            ok = resp.status_code < 500 and resp.status_code != 429
+            return resp
+        except (requests.ConnectionError, requests.Timeout), e:
+            ok = False
+            raise UpstreamConnectionError('%s could not be reached (%s)' % \
+                                          (host, e))
+        finally:
+            breaker.record(ok)
+
+    def _record_request(self, method, resp, start):
+        if getattr(resp, 'fromcache', False):
+            MANCER_CACHE.inc(mancer=self.machine_name, result='hit')
+            return
+        if self.cache_storage and method.lower() == 'get' and \
+                not getattr(_revalidating, 'active', False):
+            MANCER_CACHE.inc(mancer=self.machine_name, result='miss')
+        MANCER_REQUESTS.inc(mancer=self.machine_name, code=resp.status_code)
+        MANCER_REQUEST_SECONDS.observe(time.time() - start,
+                                       mancer=self.machine_name)
+
     def flush_cache(self):
         host = urlparse(self.base_url).netloc
-        count = 0
-        for f in os.listdir(self.cache_dir):
-            if f.startswith(host):
-                os.remove(os.path.join(self.cache_dir, f))
-                count += 1
-        return count
+        return self.cache_storage.flush(host)
 
     def get_metadata(self):
         """ 
@@ -127,6 +419,36 @@ class BaseMancer(scrapelib.Scraper):
 
         return {'term': search_term, 'geoid': search_term}
 
+    def geo_lookup_many(self, terms, geo_type=None):
+        """
+        Look up many geographies at once. The worker always calls this
+        rather than geo_lookup, with the distinct terms of a column in
+        batches.
+
+        Returns a dict mapping each of 'terms', as given, to its geoid
+        (None when nothing matched):
+
+        {
+          <search_term>: '<full_geoid>',
+          ...etc...
+        }
+
+        A MancerError should name the term that failed.
+
+        Default behavior is to call geo_lookup for each term. Subclasses
+        that can resolve a batch more cheaply than that (with one API call,
+        or by doing shared work once) should override it.
+        """
+        geoids = {}
+        for term in terms:
+            try:
+                geoids[term] = self.geo_lookup(term, geo_type=geo_type)['geoid']
+            except MancerError, e:
+                # Same class, so the worker can tell an API that's down
+                raise type(e)('%s (while looking up "%s")' % (e.message, term),
+                              body=e.body)
+        return geoids
+
     def search(self, geo_ids=None, columns=None):
         """
         This method should send the search request to the API endpoint(s).
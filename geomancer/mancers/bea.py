@@ -10,6 +10,8 @@ import re
 from urlparse import urlparse
 import us
 
+PUNCTUATION = re.compile('[%s]' % re.escape(punctuation))
+
 class BureauEconomicAnalysis(BaseMancer):
     """ 
     Subclassing the main BaseMancer class
@@ -22,6 +24,9 @@ class BureauEconomicAnalysis(BaseMancer):
     description = """ 
         GDP & Personal Income Data (2013) from the Bureau of Economic Analysis
     """
+    vintage = '2013'
+    # The API allows 100 requests a minute per key
+    rate_limit = (1.5, 10)
     api_key_required = True
 
     def __init__(self, api_key=None):
@@ -87,20 +92,38 @@ class BureauEconomicAnalysis(BaseMancer):
     def lookup_state_name(self, term):
         st = us.states.lookup(term)
         if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
+            st = next((s for s in us.STATES if s.ap_abbr == term), None)
         if st:
             return st.name
         else:
             return term
 
     def geo_lookup(self, search_term, geo_type=None):
-        regex = re.compile('[%s]' % re.escape(punctuation))
-        search_term = regex.sub('', search_term)
+        search_term = PUNCTUATION.sub('', search_term)
         if geo_type == 'state':
             return {'term': search_term, 'geoid': self.lookup_state_name(search_term)}
         else:
             return {'term': search_term, 'geoid': search_term}
 
+    def geo_lookup_many(self, terms, geo_type=None):
+        """
+        State names are resolved locally with the us package, once for each
+        spelling in the batch once punctuation is stripped ("Ill." and "Ill"
+        are one lookup). Misses aren't cached by us, so this also saves
+        repeating its full scan for every unrecognised term.
+        """
+        geoids = {}
+        names = {}
+        for term in terms:
+            cleaned = PUNCTUATION.sub('', term)
+            if geo_type != 'state':
+                geoids[term] = cleaned
+                continue
+            if cleaned not in names:
+                names[cleaned] = self.lookup_state_name(cleaned)
+            geoids[term] = names[cleaned]
+        return geoids
+
     def search(self, geo_ids=None, columns=None):
 
         column_names = {
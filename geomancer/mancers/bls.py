@@ -9,8 +9,10 @@ from string import punctuation
 import re
 from urlparse import urlparse
 import us
-import requests
 import pandas as pd
+from cStringIO import StringIO
+
+PUNCTUATION = re.compile('[%s]' % re.escape(punctuation))
 
 class BureauLaborStatistics(BaseMancer):
     """ 
@@ -24,6 +26,9 @@ class BureauLaborStatistics(BaseMancer):
     description = """ 
         Data from the Bureau of Labor Statistics
     """
+    vintage = 'oes2014_qcew2013'
+    # Keep well under the v2 API's per-key limits
+    rate_limit = (2, 10)
     api_key_required = True
 
     # store the data for each column
@@ -123,22 +128,38 @@ class BureauLaborStatistics(BaseMancer):
         return results
 
     def geo_lookup(self, search_term, geo_type=None):
-        regex = re.compile('[%s]' % re.escape(punctuation))
-        search_term = regex.sub('', search_term)
+        search_term = PUNCTUATION.sub('', search_term)
         if geo_type == 'state' or geo_type == 'state_fips':
             return {'term': search_term, 'geoid': self.lookup_state_name(search_term)}
         else:
             return {'term': search_term, 'geoid': search_term}
 
+    def geo_lookup_many(self, terms, geo_type=None):
+        """
+        Like geo_lookup, but each state spelling in the batch (after
+        punctuation is stripped) goes through lookup_state_name only once.
+        """
+        geoids = {}
+        fips = {}
+        for term in terms:
+            cleaned = PUNCTUATION.sub('', term)
+            if geo_type not in ('state', 'state_fips'):
+                geoids[term] = cleaned
+                continue
+            if cleaned not in fips:
+                fips[cleaned] = self.lookup_state_name(cleaned)
+            geoids[term] = fips[cleaned]
+        return geoids
+
     # given a search term, returns state fips code
     def lookup_state_name(self, term):
         st = us.states.lookup(term)
         if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
+            st = next((s for s in us.STATES if s.ap_abbr == term), None)
         if st:
             return st.fips
         else:
-            return search_term
+            return term
 
     def bls_oes_series_id(self, geo_id, stat_id):
         # documentation on constructing series ids at http://www.bls.gov/help/hlpforma.htm#OE
@@ -163,7 +184,7 @@ class BureauLaborStatistics(BaseMancer):
             # make the request
             headers = {'Content-type': 'application/json'}
             data = json.dumps({"seriesid": series_ids,"startyear":"2014", "endyear":"2014", "registrationKey":self.api_key})
-            p = requests.post('http://api.bls.gov/publicAPI/v2/timeseries/data/', data=data, headers=headers)
+            p = self.post('http://api.bls.gov/publicAPI/v2/timeseries/data/', data=data, headers=headers)
             json_data = json.loads(p.text)
 
             self.oes_column_data[col] = {}
@@ -176,6 +197,6 @@ class BureauLaborStatistics(BaseMancer):
 
     def qcewGetSummaryData(self, state_fips):
         urlPath = "http://www.bls.gov/cew/data/api/2013/a/area/"+state_fips+"000.csv"
-        df = pd.read_csv(urlPath)
+        df = pd.read_csv(StringIO(self.get(urlPath).content))
         summary_df = df[(df['industry_code']=='10') & (df['own_code']==0)] # industry code 10 is all industries, own code 0 is all ownership
         return summary_df
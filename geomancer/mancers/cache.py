@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+import requests
+import scrapelib
+from hashlib import sha1
+from redis import Redis
+from urlparse import urlparse
+from tempfile import NamedTemporaryFile
+from requests.structures import CaseInsensitiveDict
+from geomancer.app_config import CACHE_DIR, REDIS_QUEUE_KEY
+
+# Which storage mancers cache their upstream responses in: 'file' (one file
+# per URL in CACHE_DIR), 'sqlite' (a single database file) or 'redis' (shared
+# by every worker using CACHE_REDIS_URL)
+try:
+    from geomancer.app_config import CACHE_BACKEND
+except ImportError:
+    CACHE_BACKEND = 'file'
+
+try:
+    from geomancer.app_config import CACHE_PATH
+except ImportError:
+    CACHE_PATH = os.path.join(CACHE_DIR, 'geomancer-cache.sqlite')
+
+# Seconds a cached response is used for, None to keep using it forever
+try:
+    from geomancer.app_config import CACHE_TTL
+except ImportError:
+    CACHE_TTL = None
+
+# Seconds after which a cached response is stale: it's still used, but
+# refreshed from the upstream API in the background. None to never refresh.
+# Should be shorter than CACHE_TTL, after which responses aren't used at all.
+try:
+    from geomancer.app_config import CACHE_SOFT_TTL
+except ImportError:
+    CACHE_SOFT_TTL = None
+
+# Most bytes of response bodies kept, None for no limit. The least recently
+# used responses are evicted first.
+try:
+    from geomancer.app_config import CACHE_MAX_SIZE
+except ImportError:
+    CACHE_MAX_SIZE = None
+
+# Redis server for the 'redis' backend, None for the one the queue uses
+try:
+    from geomancer.app_config import CACHE_REDIS_URL
+except ImportError:
+    CACHE_REDIS_URL = None
+
+# Seconds entries in Redis live for when there's no TTL. Every key gets an
+# expiry so a volatile-lru maxmemory policy can evict them.
+REDIS_MAX_TTL = 60 * 60 * 24 * 30
+# zlib level for responses kept in Redis
+COMPRESS_LEVEL = 6
+# Writes between checks of the cache's size against CACHE_MAX_SIZE
+EVICT_EVERY = 100
+# Seconds between updates of an entry's last access time; saves a write on
+# most cache hits
+TOUCH_INTERVAL = 60
+
+def cache_storage(cache_dir=CACHE_DIR, ttl=None):
+    """
+    The response cache configured by CACHE_BACKEND. 'ttl' overrides
+    CACHE_TTL for one mancer.
+    """
+    if ttl is None:
+        ttl = CACHE_TTL
+    if CACHE_BACKEND == 'sqlite':
+        return SQLiteCache(CACHE_PATH, ttl=ttl, max_size=CACHE_MAX_SIZE)
+    if CACHE_BACKEND == 'redis':
+        if CACHE_REDIS_URL:
+            redis = Redis.from_url(CACHE_REDIS_URL)
+        else:
+            redis = Redis()
+        return RedisCache(redis, ttl=ttl)
+    return FileCache(cache_dir, ttl=ttl)
+
+class FileCache(scrapelib.cache.FileCache):
+    """
+    scrapelib's FileCache, which also knows how to flush the responses from
+    one host. File names start with the host, so that takes a scan of the
+    whole cache directory.
+
+    Responses are written to a temporary file that's then renamed into
+    place, so one being refreshed is never read half written. Files older
+    than 'ttl' seconds, going by their modification time, are ignored and
+    replaced on the next fetch.
+    """
+
+    def __init__(self, cache_dir, ttl=None):
+        super(FileCache, self).__init__(cache_dir)
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, self._clean_key(key))
+
+    def get(self, key):
+        """Get cache entry for key, or return None."""
+        resp = super(FileCache, self).get(key)
+        if resp is not None:
+            try:
+                resp.cached_at = os.path.getmtime(self._path(key))
+            except OSError:
+                resp.cached_at = None
+            if self.ttl is not None and resp.cached_at is not None and \
+                    time.time() - resp.cached_at > self.ttl:
+                return None
+        return resp
+
+    def set(self, key, response):
+        """Set cache entry for key with contents of response."""
+        lines = ['status: %s' % response.status_code,
+                 'encoding: %s' % response.encoding]
+        lines.extend(['%s: %s' % (h, v) for h, v in response.headers.items()])
+        tmp = NamedTemporaryFile(dir=self.cache_dir, prefix='.', delete=False)
+        try:
+            tmp.write(u'\n'.join(lines).encode('utf8'))
+            tmp.write('\n\n')
+            tmp.write(response.content)
+            tmp.close()
+            os.rename(tmp.name, self._path(key))
+        except:
+            tmp.close()
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+            raise
+
+    def flush(self, host):
+        count = 0
+        for f in os.listdir(self.cache_dir):
+            if f.startswith(host):
+                os.remove(os.path.join(self.cache_dir, f))
+                count += 1
+        return count
+
+class SQLiteCache(object):
+    """
+    Response cache in a single SQLite file, shared by every mancer and
+    worker process on the host. Entries are indexed by host, so flushing a
+    data source doesn't mean scanning the whole cache, and by the time they
+    were last used, so the least recently used ones can be evicted once the
+    bodies add up to more than 'max_size' bytes. Entries older than 'ttl'
+    seconds are ignored and replaced on the next fetch.
+
+    SQLite connections can't be shared between threads, so each thread that
+    uses the cache gets its own.
+    """
+
+    def __init__(self, path, ttl=None, max_size=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._local = threading.local()
+        self._writes = 0
+        self._build_table()
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Wait on other processes' writes rather than fail
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.text_factory = str
+            # Readers don't block the writer or each other
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _build_table(self):
+        with self._conn as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                host TEXT,
+                status INTEGER,
+                encoding TEXT,
+                headers TEXT,
+                data BLOB,
+                size INTEGER,
+                created REAL,
+                accessed REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_host '
+                         'ON responses (host)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                         'ON responses (accessed)')
+
+    def get(self, key):
+        """Get cache entry for key, or return None."""
+        row = self._conn.execute('SELECT status, encoding, headers, data, '
+            'created, accessed FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        status, encoding, headers, data, created, accessed = row
+        now = time.time()
+        if self.ttl is not None and now - created > self.ttl:
+            return None
+        if now - accessed > TOUCH_INTERVAL:
+            with self._conn as conn:
+                conn.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                             (now, key))
+        resp = requests.Response()
+        resp._content = str(data)
+        resp.status_code = status
+        resp.encoding = encoding
+        resp.headers = CaseInsensitiveDict(json.loads(headers))
+        resp.url = key
+        resp.cached_at = created
+        return resp
+
+    def set(self, key, response):
+        """Set cache entry for key with contents of response."""
+        now = time.time()
+        data = response.content
+        with self._conn as conn:
+            conn.execute('INSERT OR REPLACE INTO responses '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (key, urlparse(key).netloc, response.status_code,
+                          response.encoding, json.dumps(dict(response.headers)),
+                          sqlite3.Binary(data), len(data), now, now))
+        self._writes += 1
+        if self.max_size is not None and self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the bodies come to no
+        more than 90% of max_size. Returns the number removed.
+        """
+        conn = self._conn
+        total = conn.execute('SELECT SUM(size) FROM responses').fetchone()[0]
+        excess = (total or 0) - int(self.max_size * 0.9)
+        if excess <= 0:
+            return 0
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM responses '
+                                      'ORDER BY accessed'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with conn:
+            conn.executemany('DELETE FROM responses WHERE key = ?', keys)
+        return len(keys)
+
+    def flush(self, host):
+        """Remove the cached responses from 'host'."""
+        with self._conn as conn:
+            return conn.execute('DELETE FROM responses WHERE host = ?',
+                                (host,)).rowcount
+
+    def clear(self):
+        """Remove all records from cache."""
+        with self._conn as conn:
+            conn.execute('DELETE FROM responses')
+
+class RedisCache(object):
+    """
+    Response cache in Redis, so every worker in the cluster shares one warm
+    cache and a new node doesn't start from nothing.
+
+    Responses are zlib compressed and stored under
+    <prefix>:http:<host>:<sha1 of the URL>, which keeps keys short and
+    lets flush() find a host's responses. Each key expires after 'ttl'
+    seconds (REDIS_MAX_TTL if there's no TTL) so Redis can evict them under
+    either an allkeys or a volatile maxmemory policy.
+    """
+
+    def __init__(self, redis, prefix=REDIS_QUEUE_KEY, ttl=None):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key):
+        return '%s:http:%s:%s' % (self.prefix, urlparse(key).netloc,
+                                  sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Get cache entry for key, or return None."""
+        value = self.redis.get(self._key(key))
+        if value is None:
+            return None
+        meta, data = zlib.decompress(value).split('\n', 1)
+        meta = json.loads(meta)
+        resp = requests.Response()
+        resp._content = data
+        resp.status_code = meta['status']
+        resp.encoding = meta['encoding']
+        resp.headers = CaseInsensitiveDict(meta['headers'])
+        resp.url = key
+        resp.cached_at = meta.get('created')
+        return resp
+
+    def set(self, key, response):
+        """Set cache entry for key with contents of response."""
+        meta = json.dumps({
+            'status': response.status_code,
+            'encoding': response.encoding,
+            'headers': dict(response.headers),
+            'created': time.time(),
+        })
+        value = zlib.compress('%s\n%s' % (meta, response.content),
+                              COMPRESS_LEVEL)
+        self.redis.set(self._key(key), value, ex=self.ttl or REDIS_MAX_TTL)
+
+    def flush(self, host):
+        """Remove the cached responses from 'host'."""
+        count = 0
+        for key in self.redis.scan_iter(match='%s:http:%s:*' % (self.prefix, host)):
+            count += self.redis.delete(key)
+        return count
+
+    def clear(self):
+        """Remove all records from cache."""
+        for key in self.redis.scan_iter(match='%s:http:*' % self.prefix):
+            self.redis.delete(key)
@@ -26,6 +26,7 @@ class CensusReporter(BaseMancer):
     description = """ 
         Demographic data from the 2009 Kenya Census.
     """
+    vintage = 'census2009'
 
     def get_metadata(self):
         datasets = [
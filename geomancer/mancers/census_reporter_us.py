@@ -37,6 +37,9 @@ class CensusReporter(BaseMancer):
     description = """ 
         Demographic data from the 2013 American Community Survey.
     """
+    vintage = 'acs2013_5yr'
+    lookup_concurrency = 8
+    rate_limit = (10, 20)
 
     def get_metadata(self):
         table_ids = [
@@ -84,7 +87,7 @@ class CensusReporter(BaseMancer):
     def lookup_state(self, term, attr='name'):
         st = us.states.lookup(term)
         if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
+            st = next((s for s in us.STATES if s.ap_abbr == term), None)
         if st:
             return getattr(st, attr)
         else:
@@ -151,8 +154,10 @@ class CensusReporter(BaseMancer):
                 body = json.loads(e.body.json()['error'])
             except ValueError:
                 body = None
+            except AttributeError:
+                body = e.body
             raise MancerError('Census Reporter API returned a %s status' \
-                % response.status_code, body=body)
+                % e.response.status_code, body=body)
         results = json.loads(response)
         try:
             results = {
@@ -165,6 +170,22 @@ class CensusReporter(BaseMancer):
                 'geoid': None,
             }
         return results
+
+    def geo_lookup_many(self, terms, geo_type=None):
+        """
+        County FIPS codes are checked against the gazetteer once for the
+        whole batch rather than once a term. Everything else is handled by
+        geo_lookup a term at a time; for names that's a call to the
+        geography search, which only takes one query.
+        """
+        if geo_type == 'state_county_fips':
+            regex = re.compile('[%s]' % re.escape(punctuation))
+            cleaned = dict((term, regex.sub('', term)) for term in terms)
+            valid, message = StateCountyFIPS().validate(cleaned.values())
+            if valid:
+                return dict((term, '05000US%s' % code) \
+                            for term, code in cleaned.items())
+        return super(CensusReporter, self).geo_lookup_many(terms, geo_type=geo_type)
    
     def _chunk_geoids(self, geo_ids):
         for i in xrange(0, len(geo_ids), 100):
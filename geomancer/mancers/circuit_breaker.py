@@ -0,0 +1,105 @@
+import time
+from threading import Lock
+from collections import deque
+from geomancer.metrics import MANCER_CIRCUIT
+
+# Share of requests in the window that must fail for the circuit to open
+FAILURE_RATE = 0.5
+# Fewest requests in the window before the failure rate counts
+MIN_REQUESTS = 5
+# Seconds of requests the failure rate is worked out over
+WINDOW = 60
+# Seconds an open circuit fails requests before letting one through to see
+# whether the upstream API is back
+RESET_TIMEOUT = 30
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker(object):
+    """
+    Tracks how requests from one mancer to one upstream host are going.
+    While the host answers it's closed and requests go ahead. Once
+    FAILURE_RATE of the requests over the last WINDOW seconds (and at least
+    MIN_REQUESTS) have failed it opens, and allow() turns every request
+    down without trying, instead of each one sitting through its retries.
+    After RESET_TIMEOUT seconds a single probe request is let through: if
+    it works the circuit closes again, if not it stays open for another
+    RESET_TIMEOUT.
+
+    Failures are connection errors, timeouts and 5xx or 429 responses.
+    Other errors mean the host is up.
+    """
+
+    def __init__(self, mancer, host):
+        self.mancer = mancer
+        self.host = host
+        self.state = CLOSED
+        self.opened = None
+        self.probing = False
+        self._results = deque()
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and \
+                    time.time() - self.opened >= RESET_TIMEOUT:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+        MANCER_CIRCUIT.inc(mancer=self.mancer, event='rejected')
+        return False
+
+    def record(self, ok):
+        """
+        Record how a request that allow() let through went: True if the
+        host answered, False if it failed, None if the request was given up
+        on before it got anywhere.
+        """
+        now = time.time()
+        with self._lock:
+            if self.state != CLOSED:
+                if not self.probing:
+                    # A request from before the circuit opened
+                    return
+                self.probing = False
+                if ok:
+                    self.state = CLOSED
+                    self._results.clear()
+                    MANCER_CIRCUIT.inc(mancer=self.mancer, event='closed')
+                elif ok is False:
+                    self._open(now)
+                return
+            if ok is None:
+                return
+            self._results.append((now, ok))
+            while self._results[0][0] < now - WINDOW:
+                self._results.popleft()
+            failures = len([r for r in self._results if not r[1]])
+            if len(self._results) >= MIN_REQUESTS and \
+                    failures >= FAILURE_RATE * len(self._results):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened = now
+        MANCER_CIRCUIT.inc(mancer=self.mancer, event='opened')
+
+_breakers = {}
+_breakers_lock = Lock()
+
+def circuit_breaker(mancer, host):
+    """
+    The CircuitBreaker for requests from the mancer with machine_name
+    'mancer' to 'host', shared by every instance of the mancer in the
+    process.
+    """
+    with _breakers_lock:
+        breaker = _breakers.get((mancer, host))
+        if breaker is None:
+            breaker = _breakers[(mancer, host)] = CircuitBreaker(mancer, host)
+        return breaker
@@ -0,0 +1,149 @@
+import os
+import time
+from uuid import uuid4
+from hashlib import sha1
+from threading import Lock, Event
+from redis import Redis
+from redis.exceptions import RedisError
+from geomancer import cancellation
+from geomancer.app_config import REDIS_QUEUE_KEY
+
+# Whether identical requests from different worker processes wait on one
+# another through Redis, rather than only within a process. Only worth it
+# when the processes share a response cache (CACHE_BACKEND 'sqlite' on one
+# host, or 'redis').
+try:
+    from geomancer.app_config import COALESCE_ACROSS_PROCESSES
+except ImportError:
+    COALESCE_ACROSS_PROCESSES = False
+
+# Seconds between checks on a request another process is making
+POLL_INTERVAL = 0.1
+# Seconds another process' request is waited on at most, and the lifetime
+# of the lock it holds should it die without releasing it
+LOCK_TTL = 120
+
+redis = Redis()
+
+# Deletes the lock in KEYS[1] only if it still holds our token ARGV[1], so
+# a lock that expired and was taken by someone else is left alone
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class Flight(object):
+    """
+    A request in progress that other threads are waiting on.
+    """
+    def __init__(self):
+        self.done = Event()
+        self.response = None
+        self.error = None
+
+class Coalescer(object):
+    """
+    Single-flight for upstream requests. While a request for a key is in
+    progress, threads in the same process asking for that key wait for it
+    and get its response (or its exception) rather than making their own.
+
+    With 'across_processes', the thread making the request also takes a
+    lock in Redis under <prefix>:inflight:<sha1 of the key>. Other processes
+    wanting the same key wait for the lock to go and then make the request
+    themselves, which by then is answered from the shared cache. If the
+    first request failed and nothing was cached, the next one in line goes
+    to the upstream API instead. If Redis can't be reached requests go ahead
+    without waiting.
+    """
+
+    def __init__(self, across_processes=COALESCE_ACROSS_PROCESSES,
+                 prefix=REDIS_QUEUE_KEY):
+        self.across_processes = across_processes
+        self.prefix = prefix
+        self._flights = {}
+        self._lock = Lock()
+        self._pid = os.getpid()
+        self._release = None
+        if across_processes:
+            self._release = redis.register_script(RELEASE_LOCK)
+
+    def fetch(self, key, fetch, shared=False):
+        """
+        Return fetch() for 'key', sharing one call between every thread that
+        asks for the same key at the same time. 'shared' means the response
+        ends up in a cache other processes read, so they can wait on it too.
+
+        Returns (response, coalesced), where coalesced is True if the
+        response came from a request some other thread or process made.
+        """
+        if self._pid != os.getpid():
+            # Forked: requests in flight in the parent will never finish here
+            self._flights = {}
+            self._lock = Lock()
+            self._pid = os.getpid()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            while not flight.done.wait(1):
+                cancellation.current.check()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response, True
+
+        waited = False
+        try:
+            token = None
+            if shared and self.across_processes:
+                token, waited = self._acquire(key)
+            try:
+                flight.response = fetch()
+            finally:
+                if token is not None:
+                    self._release_lock(key, token)
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.response, waited
+
+    def _lock_key(self, key):
+        return '%s:inflight:%s' % (self.prefix, sha1(key.encode('utf-8')).hexdigest())
+
+    def _acquire(self, key):
+        """
+        Take the Redis lock for 'key', waiting for any other process that
+        holds it. Returns (token, waited); token is None if the lock
+        couldn't be had.
+        """
+        lock = self._lock_key(key)
+        token = uuid4().hex
+        waited = False
+        give_up = time.time() + LOCK_TTL
+        try:
+            while not redis.set(lock, token, nx=True, ex=LOCK_TTL):
+                waited = True
+                if time.time() > give_up:
+                    return None, waited
+                cancellation.current.check()
+                time.sleep(POLL_INTERVAL)
+        except RedisError:
+            return None, waited
+        return token, waited
+
+    def _release_lock(self, key, token):
+        try:
+            self._release(keys=[self._lock_key(key)], args=[token])
+        except RedisError:
+            pass
+
+# Shared by every mancer in the process
+coalescer = Coalescer()
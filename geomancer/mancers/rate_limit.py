@@ -0,0 +1,140 @@
+import time
+from hashlib import sha1
+from redis import Redis
+from redis.exceptions import RedisError
+from geomancer.app_config import REDIS_QUEUE_KEY
+from geomancer import cancellation
+from geomancer.cancellation import JobCancelled, JobTimedOut
+
+# Per mancer rate limits that override the mancers' own, as
+# machine_name -> (requests per second, burst)
+try:
+    from geomancer.app_config import RATE_LIMITS
+except ImportError:
+    RATE_LIMITS = {}
+
+redis = Redis()
+
+# Most seconds a caller may be made to wait for a token. Callers beyond
+# that wait without taking one, so the bucket isn't borrowed against for
+# longer than this and requests that give up don't hold up later ones.
+MAX_DELAY = 30
+# Seconds slept at a time while waiting, between checks for a cancelled or
+# timed out job
+SLEEP_SLICE = 1
+
+# Takes a token from the bucket in KEYS[1], refilled at ARGV[1] tokens a
+# second up to ARGV[2], at time ARGV[3]. When the bucket is empty the token
+# is borrowed against the refill, so callers queue up in the order they
+# arrived, unless the caller would have to wait more than ARGV[4] seconds
+# for it. Returns {1 if the token was taken or 0, the seconds the caller has
+# to wait for its token}.
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local max_delay = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - 1
+local delay = math.max(0, -tokens / rate)
+if delay > max_delay then
+    return {0, tostring(delay)}
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens))
+redis.call('HSET', KEYS[1], 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+return {1, tostring(delay)}
+"""
+
+class RateLimiter(object):
+    """
+    Token bucket kept in Redis so the request budget for an upstream API is
+    shared by every worker process on every node. Allows 'rate' requests a
+    second on average and up to 'burst' at once. There's a bucket for each
+    host and API key, so mancers that use separate keys don't eat into
+    each other's budget.
+
+    If Redis can't be reached requests go ahead unlimited rather than fail.
+    """
+
+    def __init__(self, rate, burst=1, api_key=None, prefix=REDIS_QUEUE_KEY):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.prefix = prefix
+        self.key_id = sha1(api_key).hexdigest()[:12] if api_key else 'anon'
+        self._take = redis.register_script(TOKEN_BUCKET)
+
+    def _key(self, host):
+        return '%s:ratelimit:%s:%s' % (self.prefix, host, self.key_id)
+
+    def wait(self, host, control=None, background=False):
+        """
+        Block until a request to 'host' is allowed. Returns the seconds
+        waited.
+
+        The wait is cut short with JobCancelled if 'control' (a JobControl,
+        the current job's by default) is cancelled, and JobTimedOut is
+        raised straight away if the request's turn would come after the
+        job's deadline.
+
+        'background' requests never borrow against the refill: they only
+        take a token that's there, so they don't hold up requests someone is
+        waiting on.
+        """
+        if control is None:
+            control = cancellation.current
+        start = time.time()
+        while True:
+            control.check()
+            left = control.time_left()
+            if background:
+                max_delay = 0
+            elif left is None:
+                max_delay = MAX_DELAY
+            else:
+                max_delay = min(MAX_DELAY, left)
+            try:
+                taken, delay = self._take(keys=[self._key(host)],
+                    args=[self.rate, self.burst, time.time(), max_delay])
+            except RedisError:
+                return time.time() - start
+            delay = float(delay)
+            if taken:
+                break
+            if left is not None and delay > left:
+                raise JobTimedOut('This job ran out of time waiting its turn '
+                                  'at %s' % host)
+            # Too many callers ahead of us; wait for the queue to get shorter
+            self._sleep(delay - max_delay, control)
+        try:
+            self._sleep(delay, control)
+        except JobCancelled:
+            # Hand the token back so callers behind us don't wait for it
+            try:
+                redis.hincrbyfloat(self._key(host), 'tokens', 1)
+            except RedisError:
+                pass
+            raise
+        return time.time() - start
+
+    def _sleep(self, seconds, control):
+        end = time.time() + seconds
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(SLEEP_SLICE, remaining))
+            control.check()
+
+def rate_limiter(mancer):
+    """
+    The RateLimiter for a mancer, from RATE_LIMITS or its rate_limit
+    attribute, or None if it isn't limited.
+    """
+    limit = RATE_LIMITS.get(mancer.machine_name, mancer.rate_limit)
+    if not limit:
+        return None
+    rate, burst = limit
+    return RateLimiter(rate, burst, api_key=getattr(mancer, 'api_key', None))
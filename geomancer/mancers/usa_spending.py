@@ -42,6 +42,8 @@ class USASpending(BaseMancer):
     description = """ 
         Data from the U.S. Office of Management and Budget on federal contracts awarded.
     """
+    # Contract awards are updated as they come in
+    cache_ttl = 60 * 60 * 24
 
     def get_metadata(self):
         datasets = [
@@ -119,7 +121,7 @@ class USASpending(BaseMancer):
     def lookup_state(self, term):
         st = us.states.lookup(term)
         if not st:
-            st = [s for s in us.STATES if getattr(s, 'ap_abbr') == term]
+            st = next((s for s in us.STATES if s.ap_abbr == term), None)
         if st:
             return st.abbr
         else:
@@ -139,6 +141,30 @@ class USASpending(BaseMancer):
         else:
             return {'term': search_term, 'geoid': search_term.zfill(5)}
 
+    def geo_lookup_many(self, terms, geo_type=None):
+        """
+        Same geoids as geo_lookup, with each state name or abbreviation in
+        the batch (whole terms for states, the first word of congressional
+        districts) resolved only once.
+        """
+        if geo_type not in ('state', 'congress_district'):
+            return dict((term, term.zfill(5)) for term in terms)
+        abbrs = {}
+        def lookup_state(name):
+            if name not in abbrs:
+                abbrs[name] = self.lookup_state(name)
+            return abbrs[name]
+        geoids = {}
+        for term in terms:
+            parts = term.split(' ')
+            if geo_type == 'state':
+                geoids[term] = lookup_state(term)
+            elif len(parts) > 1:
+                geoids[term] = lookup_state(parts[0]) + parts[1].zfill(2)
+            else:
+                geoids[term] = term
+        return geoids
+
     def search(self, geo_ids=None, columns=None):
         result = {'header': []}
         table_ds = {}
@@ -14,6 +14,63 @@ SUMLEV_LOOKUP = {
     "county": "050",
 }
 
+LOOKUP_TABLE = [
+    ["county","1","Mombasa"],
+    ["county","2","Kwale"],
+    ["county","3","Kilifi"],
+    ["county","4","TanaRiver"],
+    ["county","5","Lamu"],
+    ["county","6","TaitaTaveta"],
+    ["county","7","Garissa"],
+    ["county","8","Wajir"],
+    ["county","9","Mandera"],
+    ["county","10","Marsabit"],
+    ["county","11","Isiolo"],
+    ["county","12","Meru"],
+    ["county","13","TharakaNithi"],
+    ["county","14","Embu"],
+    ["county","15","Kitui"],
+    ["county","16","Machakos"],
+    ["county","17","Makueni"],
+    ["county","18","Nyandarua"],
+    ["county","19","Nyeri"],
+    ["county","20","Kirinyaga"],
+    ["county","21","Murang'a"],
+    ["county","22","Kiambu"],
+    ["county","23","Turkana"],
+    ["county","24","WestPokot"],
+    ["county","25","Samburu"],
+    ["county","26","TransNzoia"],
+    ["county","27","UasinGishu"],
+    ["county","28","ElgeyoMarakwet"],
+    ["county","29","Nandi"],
+    ["county","30","Baringo"],
+    ["county","31","Laikipia"],
+    ["county","32","Nakuru"],
+    ["county","33","Narok"],
+    ["county","34","Kajiado"],
+    ["county","35","Kericho"],
+    ["county","36","Bomet"],
+    ["county","37","Kakamega"],
+    ["county","38","Vihiga"],
+    ["county","39","Bungoma"],
+    ["county","40","Busia"],
+    ["county","41","Siaya"],
+    ["county","42","Kisumu"],
+    ["county","43","HomaBay"],
+    ["county","44","Migori"],
+    ["county","45","Kisii"],
+    ["county","46","Nyamira"],
+    ["county","47","Nairobi"],
+    ["country","KE","Kenya"],
+]
+
+def normalize_name(name):
+    return name.lower().replace(' ', '').replace('-', '')
+
+# Normalized name -> geoid
+GEOIDS = dict((l[2].lower(), l[0] + '-' + l[1]) for l in LOOKUP_TABLE)
+
 class Wazimap(BaseMancer):
     """
     Subclassing the main BaseMancer class
@@ -121,65 +178,13 @@ class Wazimap(BaseMancer):
         return term
 
     def geo_lookup(self, search_term, geo_type=None):
-        lookup_table = [
-                        ["county","1","Mombasa"],
-                        ["county","2","Kwale"],
-                        ["county","3","Kilifi"],
-                        ["county","4","TanaRiver"],
-                        ["county","5","Lamu"],
-                        ["county","6","TaitaTaveta"],
-                        ["county","7","Garissa"],
-                        ["county","8","Wajir"],
-                        ["county","9","Mandera"],
-                        ["county","10","Marsabit"],
-                        ["county","11","Isiolo"],
-                        ["county","12","Meru"],
-                        ["county","13","TharakaNithi"],
-                        ["county","14","Embu"],
-                        ["county","15","Kitui"],
-                        ["county","16","Machakos"],
-                        ["county","17","Makueni"],
-                        ["county","18","Nyandarua"],
-                        ["county","19","Nyeri"],
-                        ["county","20","Kirinyaga"],
-                        ["county","21","Murang'a"],
-                        ["county","22","Kiambu"],
-                        ["county","23","Turkana"],
-                        ["county","24","WestPokot"],
-                        ["county","25","Samburu"],
-                        ["county","26","TransNzoia"],
-                        ["county","27","UasinGishu"],
-                        ["county","28","ElgeyoMarakwet"],
-                        ["county","29","Nandi"],
-                        ["county","30","Baringo"],
-                        ["county","31","Laikipia"],
-                        ["county","32","Nakuru"],
-                        ["county","33","Narok"],
-                        ["county","34","Kajiado"],
-                        ["county","35","Kericho"],
-                        ["county","36","Bomet"],
-                        ["county","37","Kakamega"],
-                        ["county","38","Vihiga"],
-                        ["county","39","Bungoma"],
-                        ["county","40","Busia"],
-                        ["county","41","Siaya"],
-                        ["county","42","Kisumu"],
-                        ["county","43","HomaBay"],
-                        ["county","44","Migori"],
-                        ["county","45","Kisii"],
-                        ["county","46","Nyamira"],
-                        ["county","47","Nairobi"],
-                        ["country","KE","Kenya"],
-                    ]
-        geoid = None
-        for l in lookup_table:
-            if search_term.lower().replace(' ', '').replace('-', '') == l[2].lower():
-                geoid = l[0] + '-' + l[1]
-        results = {
+        return {
             'term': search_term,
-            'geoid': geoid
+            'geoid': GEOIDS.get(normalize_name(search_term))
         }
-        return results
+
+    def geo_lookup_many(self, terms, geo_type=None):
+        return dict((term, GEOIDS.get(normalize_name(term))) for term in terms)
 
     def search(self, geo_ids=None, columns=None):
         """
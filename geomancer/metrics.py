@@ -0,0 +1,234 @@
+import os
+import re
+import time
+import errno
+from threading import Lock
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+try:
+    from geomancer.app_config import METRICS_FOLDER
+except ImportError:
+    METRICS_FOLDER = '/tmp/geomancer-metrics'
+
+# Names of the files write_textfile leaves, with the worker's pid
+TEXTFILE_REGEX = re.compile(r'^worker-(\d+)\.prom$')
+
+# Upper bounds (seconds) for latency histograms
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+                600, 1800, 3600)
+# Upper bounds for job size histograms
+SIZE_BUCKETS = (10, 100, 1000, 5000, 10000, 50000, 100000, 250000, 500000,
+                1000000)
+
+REGISTRY = []
+
+class Metric(object):
+    """
+    In-process metric with optional labels, rendered in the Prometheus text
+    format. Safe to update from several threads.
+    """
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, '')) for l in self.labels)
+
+    def _label_str(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (k, v.replace('"', '\\"')) \
+                                  for k, v in pairs])
+
+    def render(self, extra=()):
+        lines = [
+            '# HELP %s %s' % (self.name, self.doc),
+            '# TYPE %s %s' % (self.name, self.kind),
+        ]
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._render_value(key, self._values[key], extra))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def _render_value(self, key, value, extra):
+        return ['%s%s %s' % (self.name, self._label_str(key, extra), value)]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key,
+                ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _render_value(self, key, value, extra):
+        counts, total, count = value
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        lines = []
+        for bound, n in zip(bounds, counts + [count]):
+            lines.append('%s_bucket%s %s' % \
+                (self.name, self._label_str(key, list(extra) + [('le', bound)]), n))
+        lines.append('%s_sum%s %s' % (self.name, self._label_str(key, extra), total))
+        lines.append('%s_count%s %s' % (self.name, self._label_str(key, extra), count))
+        return lines
+
+class StageTimer(object):
+    """
+    Times a run of consecutive stages into a histogram labelled by stage.
+    Starting a stage ends the one before it.
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.stage = None
+        self.started = None
+
+    def start(self, stage):
+        self.stop()
+        self.stage = stage
+        self.started = time.time()
+
+    def stop(self):
+        if self.stage is not None:
+            self.histogram.observe(time.time() - self.started, stage=self.stage)
+            self.stage = None
+
+def render(extra=()):
+    """
+    All metrics in the Prometheus text format. 'extra' is a list of
+    (label, value) pairs added to every sample.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render(list(extra)))
+    return '\n'.join(lines) + '\n'
+
+def textfile_path(folder=METRICS_FOLDER, pid=None):
+    return os.path.join(folder, 'worker-%s.prom' % (pid or os.getpid()))
+
+def write_textfile(folder=METRICS_FOLDER):
+    """
+    Write this process' metrics to <folder>/worker-<pid>.prom, in a form the
+    node_exporter textfile collector (or anything else that reads the
+    Prometheus text format) can pick up. Samples are labelled with the pid
+    so the files of several worker processes don't clash. The file is
+    swapped in atomically.
+    """
+    if not folder:
+        return
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    tmp = NamedTemporaryFile(dir=folder, prefix='.', delete=False)
+    try:
+        tmp.write(render([('worker', str(os.getpid()))]))
+        tmp.close()
+        os.chmod(tmp.name, 0644)
+        os.rename(tmp.name, textfile_path(folder))
+    except:
+        tmp.close()
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+
+def remove_textfile(folder=METRICS_FOLDER, pid=None):
+    """
+    Remove the metrics file of this process, or of the process 'pid'.
+    """
+    if folder and os.path.exists(textfile_path(folder, pid)):
+        os.remove(textfile_path(folder, pid))
+
+def prune_textfiles(folder=METRICS_FOLDER):
+    """
+    Remove the metrics files of worker processes that are no longer running
+    on this machine, which would otherwise be collected forever. Returns the
+    number of files removed.
+    """
+    if not folder or not os.path.isdir(folder):
+        return 0
+    count = 0
+    for fname in os.listdir(folder):
+        match = TEXTFILE_REGEX.match(fname)
+        if match is None:
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                # Running, as someone else
+                continue
+            try:
+                os.remove(os.path.join(folder, fname))
+                count += 1
+            except OSError:
+                # Someone else got to it first
+                pass
+    return count
+
+# Worker metrics
+
+JOBS = Counter('geomancer_jobs_total',
+    'Jobs run by the worker, by task and outcome', ('task', 'status'))
+JOB_SECONDS = Histogram('geomancer_job_seconds',
+    'Time spent running each job', ('task',))
+QUEUE_WAIT_SECONDS = Histogram('geomancer_queue_wait_seconds',
+    'Time jobs spent on the queue before a worker picked them up', ('queue',))
+JOB_ROWS = Histogram('geomancer_job_rows',
+    'Rows in each spreadsheet enriched', buckets=SIZE_BUCKETS)
+JOB_COLUMNS = Histogram('geomancer_job_columns',
+    'Tables appended to each spreadsheet', buckets=(1, 2, 3, 5, 10, 20, 50))
+STAGE_SECONDS = Histogram('geomancer_stage_seconds',
+    'Time spent in each stage of do_the_work', ('stage',))
+
+# Mancer metrics
+
+MANCER_REQUESTS = Counter('geomancer_mancer_requests_total',
+    'HTTP requests made to upstream APIs, by mancer and status code',
+    ('mancer', 'code'))
+MANCER_REQUEST_SECONDS = Histogram('geomancer_mancer_request_seconds',
+    'Latency of HTTP requests to upstream APIs', ('mancer',))
+MANCER_RATE_LIMIT_WAIT = Histogram('geomancer_mancer_rate_limit_wait_seconds',
+    'Time requests to upstream APIs waited on the shared rate limit',
+    ('mancer',))
+MANCER_COALESCED = Counter('geomancer_mancer_coalesced_total',
+    'Requests to upstream APIs answered by an identical request already in '
+    'flight', ('mancer',))
+MANCER_CIRCUIT = Counter('geomancer_mancer_circuit_total',
+    'Circuit breaker events for upstream APIs, by mancer and event (opened, '
+    'closed or rejected)', ('mancer', 'event'))
+MANCER_CACHE = Counter('geomancer_mancer_cache_total',
+    'Mancer response cache lookups, by mancer and hit, miss or stale (a hit '
+    'that is refreshed in the background), and refresh_dropped for stale hits '
+    'not refreshed as too many refreshes were waiting',
+    ('mancer', 'result'))
@@ -0,0 +1,117 @@
+import json
+import time
+from threading import Lock
+
+# Least number of seconds between progress writes to Redis
+PROGRESS_INTERVAL = 1
+# Seconds a job's progress is kept after its last update
+PROGRESS_TTL = 60 * 60
+
+# For each stage, the counter that measures how far along it is and the
+# total it is counting towards. Used to work out the ETA.
+STAGE_COUNTERS = {
+    'lookup': ('geos_resolved', 'geos_total'),
+    'search': ('searches_done', 'searches_total'),
+    'writing': ('rows_written', 'num_rows'),
+}
+
+def progress_key(result_key):
+    return '%s:progress' % result_key
+
+class JobProgress(object):
+    """
+    Keeps track of how far along a job is and publishes it to Redis as JSON
+    under progress_key(result_key) so the API can report it while the job
+    runs. Writes are throttled to one every PROGRESS_INTERVAL seconds, apart
+    from stage changes which always go out. Safe to update from the lookup
+    and search threads.
+
+    Looks like this once published:
+
+    {
+        'stage': 'lookup',
+        'rows_scanned': 50000,
+        'num_rows': 50000,
+        'geos_resolved': 120,
+        'geos_total': 300,
+        'searches_done': 0,
+        'searches_total': 3,
+        'rows_written': 0,
+        'eta': 4.2,   # estimated seconds left in the current stage
+        'elapsed': 12.5,
+        'updated': 1415660000.0,
+    }
+
+    With no redis connection or key nothing is published, so the job
+    functions can report progress without checking whether anyone listens.
+    """
+
+    def __init__(self, redis=None, result_key=None):
+        self.redis = redis
+        self.key = progress_key(result_key) if result_key else None
+        self.started = time.time()
+        self.stage_started = self.started
+        self.state = {
+            'stage': 'started',
+            'rows_scanned': 0,
+            'num_rows': None,
+            'geos_resolved': 0,
+            'geos_total': None,
+            'searches_done': 0,
+            'searches_total': None,
+            'rows_written': 0,
+            'eta': None,
+        }
+        self._lock = Lock()
+        self._published = 0
+
+    def stage(self, name, **fields):
+        with self._lock:
+            self.state['stage'] = name
+            self.stage_started = time.time()
+            self.state.update(fields)
+            self._publish()
+
+    def update(self, **fields):
+        with self._lock:
+            self.state.update(fields)
+            self._maybe_publish()
+
+    def advance(self, counter, n=1):
+        with self._lock:
+            self.state[counter] += n
+            self._maybe_publish()
+
+    def _maybe_publish(self):
+        if time.time() - self._published >= PROGRESS_INTERVAL:
+            self._publish()
+
+    def _eta(self, now):
+        try:
+            done, total = [self.state[c] for c in STAGE_COUNTERS[self.state['stage']]]
+        except KeyError:
+            return None
+        if not done or not total:
+            return None
+        elapsed = now - self.stage_started
+        return round(elapsed * (total - done) / float(done), 1)
+
+    def _publish(self):
+        now = time.time()
+        self._published = now
+        self.state['eta'] = self._eta(now)
+        if self.redis is None or self.key is None:
+            return
+        state = dict(self.state, updated=now,
+                     elapsed=round(now - self.started, 1))
+        self.redis.set(self.key, json.dumps(state))
+        self.redis.expire(self.key, PROGRESS_TTL)
+
+def get_progress(redis, result_key):
+    """
+    Latest published progress for a job, or None if there isn't any yet.
+    """
+    state = redis.get(progress_key(result_key))
+    if state is None:
+        return None
+    return json.loads(state)
@@ -16,6 +16,7 @@ from geomancer.helpers import import_class, get_geo_types, get_data_sources, \
     guess_geotype, check_combos, SENSICAL_TYPES
 from geomancer.app_config import ALLOWED_EXTENSIONS, \
     MAX_CONTENT_LENGTH
+from geomancer import blob_store
 from werkzeug.exceptions import RequestEntityTooLarge
 
 
@@ -104,7 +105,7 @@ def upload():
                     session['sample_data'] = sample_data
                     session['guesses'] = json.dumps(guesses)
                     outp.seek(0)
-                    session['file'] = outp.getvalue()
+                    session['file'] = blob_store.store(outp)
                     session['filename'] = f.filename
                     return redirect(url_for('views.select_geo'))
             else:
@@ -121,7 +122,7 @@ def select_geo():
         return redirect(url_for('views.index'))
     context = {}
     if request.method == 'POST':
-        inp = StringIO(session['file'])
+        inp = blob_store.open_blob(blob_store.session_file(session))
         reader = UnicodeCSVReader(inp)
         header = reader.next()
         fields = {}
@@ -5,20 +5,132 @@ from uuid import uuid4
 import sys
 import os
 import re
+import math
+import time
+import errno
+import signal
+import socket
+import json
+from hashlib import sha1
 from cStringIO import StringIO
 from csvkit.unicsv import UnicodeCSVReader, UnicodeCSVWriter
-from geomancer.mancers.base import MancerError
-from geomancer.helpers import import_class, find_geo_type, get_geo_types
-from geomancer.app_config import RESULT_FOLDER, MANCERS, MANCER_KEYS
+from geomancer.mancers.base import MancerError, UpstreamUnavailable
+from geomancer.helpers import import_class, find_geo_type, get_geo_types, \
+    registry as mancer_registry
+from geomancer.blob_store import open_blob, store, prune, REF_REGEX
+from geomancer.progress import JobProgress
+from geomancer.checkpoint import Checkpoint, prune as prune_checkpoints
+from geomancer import cancellation
+from geomancer.cancellation import JobControl, JobCancelled, cancel_key
+from geomancer.metrics import StageTimer, STAGE_SECONDS, JOBS, JOB_SECONDS, \
+    QUEUE_WAIT_SECONDS, JOB_ROWS, JOB_COLUMNS, write_textfile, remove_textfile, \
+    prune_textfiles
+from geomancer.app_config import RESULT_FOLDER, MANCERS, \
+    REDIS_QUEUE_KEY
 from datetime import datetime
 import xlwt
 from openpyxl import Workbook
 from openpyxl.cell import get_column_letter
-from itertools import izip_longest
+from itertools import izip_longest, izip, cycle
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Event
+from collections import OrderedDict
+from array import array
 import traceback
 
 redis = Redis()
 
+# Progress of the job this process is working on. queue_daemon swaps in one
+# that publishes to Redis for each job; this one reports to nobody.
+progress = JobProgress()
+
+# Seconds to block on the preferred queue when every queue is empty. Jobs
+# on the other queues wait at most this long to be noticed, and so does a
+# shutdown request.
+POLL_TIMEOUT = 1
+# Seconds to wait before replacing a worker process that died
+RESPAWN_DELAY = 1
+# Seconds between clean ups of old uploads and checkpoints while the queue
+# is idle
+PRUNE_INTERVAL = 60 * 60
+# Rows between progress updates while reading or writing a file
+PROGRESS_ROWS = 1000
+# Most appended columns searched at the same time within one job
+SEARCH_THREADS = 8
+# Most distinct terms handed to one geo_lookup_many call
+LOOKUP_BATCH_SIZE = 100
+# Rows per sheet in .xls output, the format's limit
+XLS_MAX_ROWS = 65536
+# Rows xlwt holds in memory before serialising them
+XLS_FLUSH_ROWS = 1000
+# Term code of a row with nothing in its geography column(s)
+NO_TERM = -1
+# Default job queues, in priority order, with their scheduling weights.
+# Override with JOB_QUEUES in app_config.
+JOB_QUEUES = (('interactive', 4), ('bulk', 1))
+# Jobs with fewer cells than this (rows x appended columns) are interactive
+SMALL_JOB_CELLS = 20000
+# Most jobs from one session that may run at the same time (0 for no limit)
+SESSION_JOB_LIMIT = 2
+# Seconds to back off after putting back a job over its session's limit
+DEFER_DELAY = 0.1
+# Seconds before a session's count of running jobs is forgotten, in case a
+# worker died without decrementing it
+RUNNING_TTL = 60 * 60
+# Seconds between a worker's heartbeats, and how long one lasts. A worker
+# whose heartbeat has expired is taken for dead and its job requeued.
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TTL = 60
+# Seconds between checks for dead workers
+REAP_INTERVAL = 60
+# Seconds a job has from a worker taking it to finishing before it's
+# stopped. A job requeued after its worker died starts over with the full
+# limit. Override with JOB_TIME_LIMIT in app_config, and for single queues
+# (by name) with JOB_TIME_LIMITS.
+JOB_TIME_LIMIT = 60 * 60
+JOB_TIME_LIMITS = {'bulk': 6 * 60 * 60}
+# Times a job may be taken by a worker that then dies before it goes to the
+# dead letter list instead of back on its queue
+JOB_MAX_ATTEMPTS = 3
+
+# Moves the job at the left hand end of KEYS[1] onto KEYS[2], the way
+# RPOPLPUSH does from the right, for queues filled with RPUSH
+LPOPLPUSH = """
+local payload = redis.call('LPOP', KEYS[1])
+if payload then
+    redis.call('LPUSH', KEYS[2], payload)
+end
+return payload
+"""
+
+# Deletes the lock in KEYS[1] only if it still holds our token ARGV[1]
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+lpoplpush = redis.register_script(LPOPLPUSH)
+release_lock = redis.register_script(RELEASE_LOCK)
+
+# Migration setting for upgrading from releases that pickled jobs and
+# results. When True, jobs go on the single REDIS_QUEUE_KEY list as pickled
+# tuples carrying the whole file, results are pickled, and pickles are read
+# as well as JSON. Only turn it on while old and new web apps and workers
+# run side by side: unpickling what's in Redis runs whatever code it names,
+# and jobs queued as pickles skip the job queues, session limits and time
+# limits. When False anything that isn't JSON is refused.
+try:
+    from geomancer.app_config import ACCEPT_LEGACY_PICKLE
+except ImportError:
+    ACCEPT_LEGACY_PICKLE = False
+
+try:
+    from geomancer.app_config import RESULT_CACHE_TTL
+except ImportError:
+    RESULT_CACHE_TTL = 60 * 60 * 24
+
 try:
     from raven import Client
     from geomancer.app_config import SENTRY_DSN
@@ -28,31 +140,163 @@ except ImportError:
 except KeyError:
     client = None
 
+# Version of the job envelope written by queuefunc. Workers read any
+# envelope up to this version and ignore fields they don't know about, so
+# only bump it for changes older workers can't cope with.
+JOB_VERSION = 1
+
+# Task name -> function, filled in by queuefunc. Jobs name the task to run
+# rather than carrying a pickled function.
+TASKS = {}
+
+class UnknownJobVersion(Exception):
+    pass
+
+class LegacyPayload(Exception):
+    pass
+
+def encode_job(task, key, args, kwargs, **extra):
+    job = {
+        'v': JOB_VERSION,
+        'task': task,
+        'key': key,
+        'args': args,
+        'kwargs': kwargs,
+        'enqueued': time.time(),
+    }
+    job.update(extra)
+    return json.dumps(job, separators=(',', ':'))
+
+def encode_legacy_job(func, key, args, kwargs):
+    """
+    The pickled (function, key, args, kwargs) tuple workers from before the
+    envelope expect, with the file itself rather than a reference to it.
+    """
+    if func.__name__ == 'do_the_work':
+        f = open_blob(args[0])
+        try:
+            args = (f.read(),) + tuple(args[1:])
+        finally:
+            f.close()
+    return dumps((func, key, args, kwargs))
+
+def decode_job(payload):
+    """
+    Turn a queued payload back into a job dict with the task function under
+    'func'. Pickled (function, key, args, kwargs) tuples queued by code from
+    before the envelope are only accepted with ACCEPT_LEGACY_PICKLE, and
+    raise LegacyPayload otherwise.
+    """
+    if not payload.startswith('{'):
+        if not ACCEPT_LEGACY_PICKLE:
+            raise LegacyPayload('Refused a job that is not JSON')
+        func, key, args, kwargs = loads(payload)
+        if func.__name__ == 'do_the_work' and not REF_REGEX.match(args[0]):
+            # These carried the whole file rather than a reference to it
+            args = (store(StringIO(args[0])),) + tuple(args[1:])
+        return {'v': 0, 'task': func.__name__, 'func': func, 'key': key,
+                'args': args, 'kwargs': kwargs}
+    job = json.loads(payload)
+    if job['v'] > JOB_VERSION:
+        raise UnknownJobVersion('Job envelope version %s is newer than %s' \
+            % (job['v'], JOB_VERSION))
+    job['func'] = TASKS[job['task']]
+    return job
+
+def encode_result(rv):
+    if ACCEPT_LEGACY_PICKLE:
+        # Web apps from before results were JSON only read pickles
+        return dumps(rv)
+    return json.dumps(rv, separators=(',', ':'))
+
+def decode_result(payload):
+    if payload.startswith('{'):
+        return json.loads(payload)
+    if not ACCEPT_LEGACY_PICKLE:
+        raise LegacyPayload('Refused a result that is not JSON')
+    # Written by a worker from before results were JSON
+    return loads(payload)
+
 class DelayedResult(object):
     def __init__(self, key):
         self.key = key
         self._rv = None
 
+    @classmethod
+    def finished(cls, rv, rv_ttl=500):
+        """
+        A result that's ready without going through the queue.
+        """
+        key = '%s:result:%s' % (REDIS_QUEUE_KEY, str(uuid4()))
+        redis.set(key, encode_result(rv))
+        redis.expire(key, rv_ttl)
+        return cls(key)
+
     @property
     def return_value(self):
         if self._rv is None:
             rv = redis.get(self.key)
             if rv is not None:
-                self._rv = loads(rv)
+                try:
+                    self._rv = decode_result(rv)
+                except LegacyPayload, e:
+                    self._rv = {'status': 'error', 'result': e.message}
         return self._rv
     
+def job_queues(config):
+    """
+    Redis keys of the job queues in priority order, with their scheduling
+    weights.
+    """
+    qkey = config['REDIS_QUEUE_KEY']
+    return [('%s:%s' % (qkey, name), weight) \
+            for name, weight in config.get('JOB_QUEUES', JOB_QUEUES)]
+
+def job_time_limit(config, queue):
+    """
+    Seconds a job on 'queue' (its Redis key) has to finish once a worker
+    takes it.
+    """
+    name = queue[len(config['REDIS_QUEUE_KEY']) + 1:]
+    limits = config.get('JOB_TIME_LIMITS', JOB_TIME_LIMITS)
+    return limits.get(name, config.get('JOB_TIME_LIMIT', JOB_TIME_LIMIT))
+
+def choose_queue(config, num_rows, num_columns):
+    """
+    Small jobs go on the first (interactive) queue, everything else on the
+    last one so a two row test upload doesn't wait behind a huge file.
+    """
+    queues = job_queues(config)
+    if num_rows * num_columns < config.get('SMALL_JOB_CELLS', SMALL_JOB_CELLS):
+        return queues[0][0]
+    return queues[-1][0]
+
 def queuefunc(f):
-    def delay(*args, **kwargs):
+    TASKS[f.__name__] = f
+    def enqueue(args=(), kwargs=None, queue=None, session_id=None):
         qkey = current_app.config['REDIS_QUEUE_KEY']
         key = '%s:result:%s' % (qkey, str(uuid4()))
-        s = dumps((f, key, args, kwargs))
-        redis.rpush(current_app.config['REDIS_QUEUE_KEY'], s)
+        if ACCEPT_LEGACY_PICKLE:
+            # Older workers only know the one queue, and take jobs off its
+            # left hand end
+            redis.rpush(qkey, encode_legacy_job(f, key, args, kwargs or {}))
+            return DelayedResult(key)
+        if queue is None:
+            queue = job_queues(current_app.config)[-1][0]
+        s = encode_job(f.__name__, key, args, kwargs or {},
+                       queue=queue, session=session_id,
+                       time_limit=job_time_limit(current_app.config, queue))
+        # Workers take jobs off the right hand end
+        redis.lpush(queue, s)
         return DelayedResult(key)
+    def delay(*args, **kwargs):
+        return enqueue(args, kwargs)
+    f.enqueue = enqueue
     f.delay = delay
     return f
 
 @queuefunc
-def do_the_work(file_contents, field_defs, filename):
+def do_the_work(file_ref, field_defs, filename):
     """
       field_defs looks like:
       {
@@ -73,177 +317,689 @@ def do_the_work(file_contents, field_defs, filename):
 
       where the semicolon separated values represent a multicolumn geography
 
-      file_contents is a string containing the contents of the uploaded file.
-    """
-    contents = StringIO(file_contents)
-    reader = UnicodeCSVReader(contents)
-    header = reader.next()
-    result = None
-    geo_ids = set()
-    mancer_mapper = {}
-    fields_key = field_defs.keys()[0]
-    errors = []
-
-    geo_type, col_idxs, val_fmt = find_geo_type(field_defs[fields_key]['type'], 
-                                       fields_key)
-    geo_name = get_geo_types(geo_type=geo_type)[0][0]['info'].human_name
-    for mancer in MANCERS:
-        m = import_class(mancer)
-        api_key = MANCER_KEYS.get(m.machine_name)
-        try:
-            m = m(api_key=api_key)
-        except ImportError, e:
-            errors.append(e.message)
-            continue
-        mancer_cols = [c['table_id'] for c in m.get_metadata()]
+      file_ref is a reference to the uploaded CSV in the blob store (see
+      geomancer.blob_store).
+    """
+    stages = StageTimer(STAGE_SECONDS)
+    stages.start('setup')
+    checkpoint = Checkpoint(job_fingerprint(file_ref, field_defs, filename))
+    contents = open_blob(file_ref)
+    try:
+        reader = UnicodeCSVReader(contents)
+        header = reader.next()
+        mancer_mapper = {}
+        fields_key = field_defs.keys()[0]
+        errors = []
+
+        geo_type, col_idxs, val_fmt = find_geo_type(field_defs[fields_key]['type'], 
+                                           fields_key)
+        geo_name = get_geo_types(geo_type=geo_type)[0][0]['info'].human_name
+        errors.extend(mancer_registry.get()['errors'])
         for k, v in field_defs.items():
             field_cols = v['append_columns']
             for f in field_cols:
-                if f in mancer_cols:
+                m = mancer_registry.route(f)
+                if m is not None:
                     mancer_mapper[f] = {
                         'mancer': m,
-                        'geo_id_map': {},
                         'geo_ids': set(),
                         'geo_type': geo_type,
                     }
-    for row_idx, row in enumerate(reader):
-        vals = [re.sub(r'(?i)county', '', unicode(row[int(i)])).strip() \
-                for i in col_idxs]
-        val = val_fmt.format(*vals)
-        for column in field_cols:
+
+        def row_term(row):
+            vals = [re.sub(r'(?i)county', '', unicode(row[int(i)])).strip() \
+                    for i in col_idxs]
+            return val_fmt.format(*vals)
+
+        # First pass: collapse the rows down to their distinct geographies so
+        # that each one is only looked up once per mancer, however many rows
+        # mention it. Each distinct term gets an integer code and all that's
+        # kept of a row is its term's code, four bytes a row.
+        stages.start('scanning')
+        progress.stage('scanning')
+        terms = OrderedDict()
+        row_codes = array('i')
+        num_rows = 0
+        for row in reader:
+            num_rows += 1
+            term = row_term(row)
+            if term:
+                code = terms.setdefault(term, len(terms))
+            else:
+                code = NO_TERM
+            row_codes.append(code)
+            if num_rows % PROGRESS_ROWS == 0:
+                progress.update(rows_scanned=num_rows)
+                cancellation.current.check()
+
+        # Appended columns go into the output in the order they were asked for
+        columns = [c for c in field_cols if c in mancer_mapper]
+        num_mancers = len(set([mancer_mapper[c]['mancer'] for c in columns]))
+        JOB_ROWS.observe(num_rows)
+        JOB_COLUMNS.observe(len(columns))
+        stages.start('lookup')
+        progress.stage('lookup', rows_scanned=num_rows, num_rows=num_rows,
+                       geos_total=len(terms) * num_mancers)
+        mancer_geoids = {}
+        # Mancers whose API went down during the job. The job finishes without
+        # them and their columns are left blank.
+        down = set()
+        for column in columns:
             mancer = mancer_mapper[column]['mancer']
-            try:
-                if val:
-                    geoid_search = mancer.geo_lookup(val, geo_type=geo_type)
-                else:
-                    continue
-            except MancerError, e:
-                return 'Error message: %s, Body: %s' % (e.message, e.body)
-            row_geoid = geoid_search['geoid']
-            if row_geoid:
-                mancer_mapper[column]['geo_ids'].add(row_geoid)
+            if mancer not in mancer_geoids:
+                cancellation.current.check()
                 try:
-                    mancer_mapper[column]['geo_id_map'][row_geoid].append(row_idx)
-                except KeyError:
-                    mancer_mapper[column]['geo_id_map'][row_geoid] = [row_idx]
-    all_data = {'header': []}
-    contents.seek(0)
-    all_rows = list(reader)
-    included_idxs = set()
-    header_row = all_rows.pop(0)
-    output = [[] for i in range(len(all_rows) + 1)]
-
-    response = {
-        'download_url': None,
-        'geo_col': field_defs.values()[0]['type'],
-        'num_rows': len(all_rows),
-        'num_matches': 0,
-        'num_missing': 0,
-        'cols_added': header_row[:],
-        'errors': errors,
-    }
+                    mancer_geoids[mancer] = lookup_geoids(mancer, terms.keys(),
+                                                          geo_type, checkpoint)
+                except UpstreamUnavailable:
+                    down.add(mancer)
+                    mancer_geoids[mancer] = {}
+                except MancerError, e:
+                    return 'Error message: %s, Body: %s' % (e.message, e.body)
+            mancer_mapper[column]['geo_ids'].update(
+                [g for g in mancer_geoids[mancer].values() if g])
+        stages.start('search')
+        progress.stage('search', searches_total=len(columns))
+        search_results = search_columns(mancer_mapper, columns, down, checkpoint)
+        cancellation.current.check()
+        stages.start('assembly')
 
-    for column, defs in mancer_mapper.items():
-        geo_ids = defs['geo_ids']
-        all_data.update({gid:[] for gid in geo_ids})
-        geoid_mapper = defs['geo_id_map']
-        geo_type = defs['geo_type']
-        if geo_ids:
-            mancer = defs['mancer']
+        # Work out the values each distinct term adds to a row, indexed by the
+        # term's code, so the second pass is a single list lookup per row
+        # whatever the number of columns. Terms that matched nothing get None.
+        added_header = []
+        code_values = [[] for term in terms]
+        matched = [False for term in terms]
+        blanked = OrderedDict()
+        for column, data in izip(columns, search_results):
+            mancer = mancer_mapper[column]['mancer']
+            if mancer in down:
+                name = table_name(mancer, column)
+                blanked.setdefault(mancer, []).append(name)
+                data = {'header': [name]}
+            added_header.extend(['{0} ({1})'.format(h, geo_name) \
+                                 for h in data['header']])
+            blank = ['' for h in data['header']]
+            geoids = mancer_geoids[mancer_mapper[column]['mancer']]
+            for term, code in terms.iteritems():
+                geoid = geoids.get(term)
+                if geoid:
+                    matched[code] = True
+                    code_values[code].extend(
+                        (list(data.get(geoid) or []) + blank)[:len(blank)])
+                else:
+                    code_values[code].extend(blank)
+        code_values = [v if m else None for v, m in izip(code_values, matched)]
+        no_values = ['' for h in added_header]
+        for mancer, names in blanked.items():
+            errors.append('%s could not be reached, so these columns were left '
+                          'blank: %s' % (mancer.name, ', '.join(names)))
+
+        response = {
+            'download_url': None,
+            'geo_col': field_defs.values()[0]['type'],
+            'num_rows': num_rows,
+            'num_matches': 0,
+            'num_missing': 0,
+            'cols_added': header[:],
+            'errors': errors,
+        }
+
+        def output_rows():
+            # Second pass: read, enrich and hand rows on to the writer one at a
+            # time so memory use doesn't depend on the size of the file.
+            f = open_blob(file_ref)
             try:
-                gids = [(geo_type, g,) for g in list(geo_ids)]
-                data = mancer.search(geo_ids=gids, columns=[column])
-            except MancerError, e:
-                if client:
-                    client.captureException()
-                raise e
-            header_vals = ['{0} ({1})'.format(h, geo_name) for h in data['header']]
-            all_data['header'].extend(header_vals)
-            for gid in geo_ids:
-                try:
-                    all_data[gid].extend(data[gid])
-                except KeyError:
-                    all_data[gid].extend(['' for i in data.values()[0]])
-        else:
+                reader = UnicodeCSVReader(f)
+                header_row = reader.next()
+                yield header_row + added_header
+                for row_idx, row in enumerate(reader):
+                    if row_idx % PROGRESS_ROWS == 0:
+                        progress.update(rows_written=row_idx)
+                        cancellation.current.check()
+                    # Cut long rows and pad short ones so the appended values
+                    # line up with the header
+                    row = row[:len(header_row)]
+                    row.extend(['' for i in range(len(header_row) - len(row))])
+                    code = row_codes[row_idx]
+                    values = code_values[code] if code != NO_TERM else None
+                    if values is not None:
+                        row.extend(values)
+                    else:
+                        response['num_missing'] += 1
+                        row.extend(no_values)
+                    yield row
+            finally:
+                f.close()
+
+        stages.start('writing')
+        progress.stage('writing')
+        name, ext = os.path.splitext(filename)
+        fname = '%s_%s%s' % (name, datetime.now().isoformat(), ext)
+        fpath = '%s/%s' % (RESULT_FOLDER, fname)
+        try:
+            if ext == '.xlsx':
+                writeXLSX(fpath, output_rows())
+            elif ext == '.xls':
+                writeXLS(fpath, output_rows())
+            else:
+                writeCSV(fpath, output_rows())
+        except JobCancelled:
+            # Nobody is going to download half a spreadsheet
+            if os.path.exists(fpath):
+                os.remove(fpath)
+            raise
+        stages.stop()
+        progress.update(rows_written=num_rows)
+        response['download_url'] = '/download/%s' % fname
+        response['num_matches'] = response['num_rows'] - response['num_missing']
+        response['cols_added'] = list(set(header + added_header) - set(header))
+        if not blanked:
+            cache_key = result_cache_key(file_ref, field_defs, filename)
+            redis.set(cache_key, encode_result(response))
+            redis.expire(cache_key, RESULT_CACHE_TTL)
+            checkpoint.clear()
+        # Otherwise keep what did get done for when the job is run again
+        return response
+    finally:
+        # clear() only runs for complete results; errors, cancellations and
+        # degraded results leave the checkpoint's lookup files open otherwise
+        contents.close()
+        checkpoint.close()
+
+def table_name(mancer, table_id):
+    """
+    The human name of one of a mancer's tables, from its metadata.
+    """
+    for table in mancer_registry.get()['metadata'].get(mancer.machine_name, []):
+        if table['table_id'] == table_id:
+            return table['human_name']
+    return table_id
+
+def job_fingerprint(file_ref, field_defs, filename):
+    """
+    Hash identifying the work a job does. Identical jobs (same file
+    contents, field definitions, output format and data vintages) share it.
+    The file reference is already a hash of the contents.
+    """
+    vintages = [(m, import_class(m).vintage) for m in MANCERS]
+    ext = os.path.splitext(filename)[1].lower()
+    fingerprint = json.dumps([file_ref, field_defs, ext, vintages],
+                             sort_keys=True)
+    return sha1(fingerprint).hexdigest()
+
+def result_cache_key(file_ref, field_defs, filename):
+    """
+    Redis key for the result of enriching a file, shared by identical jobs.
+    """
+    return '%s:cache:%s' % (REDIS_QUEUE_KEY,
+                            job_fingerprint(file_ref, field_defs, filename))
+
+def cached_result(file_ref, field_defs, filename):
+    """
+    Returns the response of an earlier identical job if it's still cached
+    and its output file is still around, otherwise None.
+    """
+    rv = redis.get(result_cache_key(file_ref, field_defs, filename))
+    if rv is None:
+        return None
+    try:
+        rv = decode_result(rv)
+    except LegacyPayload:
+        return None
+    fname = rv['download_url'].rsplit('/', 1)[-1]
+    if not os.path.exists(os.path.join(RESULT_FOLDER, fname)):
+        return None
+    return rv
+
+def search_columns(mancer_mapper, columns, down, checkpoint=None):
+    """
+    Run mancer.search for every appended column at the same time, so a job
+    takes about as long as its slowest data source rather than the sum of
+    all of them. Returns the search results in the same order as 'columns'.
+
+    Each result is saved to the checkpoint, if given, and columns with a
+    saved result aren't searched again.
+
+    Mancers in the set 'down' aren't asked, and one whose API can't be
+    reached is added to it. The result for their columns is None, so the
+    job can go on without them.
+    """
+    for column in columns:
+        defs = mancer_mapper[column]
+        if not defs['geo_ids'] and defs['mancer'] not in down:
             raise MancerError('No geographies matched')
-        for col in all_data['header']:
-            if col not in header_row:
-                header_row.append(col)
-        for geoid, row_ids in geoid_mapper.items():
-            for row_id in row_ids:
-                included_idxs.add(row_id)
-                row = all_rows[row_id]
-                row.extend(all_data[geoid])
-                output[row_id] = row
-        output.insert(0, header_row)
-    all_row_idxs = set(list(range(len(all_rows))))
-    missing_rows = all_row_idxs.difference(included_idxs)
-    for idx in sorted(missing_rows):
-        row = all_rows[idx]
-        diff = len(output[0]) - len(row)
-        row.extend(['' for i in range(diff)])
-        output[idx] = row
-    response['num_missing'] = len(missing_rows) # store away missing rows
-    name, ext = os.path.splitext(filename)
-    fname = '%s_%s%s' % (name, datetime.now().isoformat(), ext)
-    fpath = '%s/%s' % (RESULT_FOLDER, fname)
-    if ext == '.xlsx':
-        writeXLSX(fpath, output)
-    elif ext == '.xls':
-        writeXLS(fpath, output)
+
+    def search(column):
+        cancellation.current.check()
+        data = checkpoint.search_result(column) if checkpoint else None
+        if data is not None:
+            progress.advance('searches_done')
+            return data
+        defs = mancer_mapper[column]
+        if defs['mancer'] in down:
+            progress.advance('searches_done')
+            return None
+        gids = [(defs['geo_type'], g,) for g in sorted(defs['geo_ids'])]
+        try:
+            data = defs['mancer'].search(geo_ids=gids, columns=[column])
+        except UpstreamUnavailable:
+            down.add(defs['mancer'])
+            progress.advance('searches_done')
+            return None
+        except MancerError:
+            if client:
+                client.captureException()
+            raise
+        if checkpoint:
+            checkpoint.save_search_result(column, data)
+        progress.advance('searches_done')
+        return data
+
+    threads = min(SEARCH_THREADS, len(columns))
+    if threads <= 1:
+        return [search(column) for column in columns]
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(search, columns)
+    finally:
+        pool.terminate()
+
+def lookup_geoids(mancer, terms, geo_type, checkpoint=None):
+    """
+    Resolve each distinct search term to a geoid using the given mancer.
+    Returns an OrderedDict mapping each term, in the order given, to its
+    geoid (None when nothing matched).
+
+    Terms go to mancer.geo_lookup_many in batches of up to
+    LOOKUP_BATCH_SIZE, run on up to mancer.lookup_concurrency threads so
+    mancers that search a remote API aren't stuck waiting on one round
+    trip at a time. MancerErrors from the mancer are passed on as they are;
+    they name the term that failed.
+
+    With a checkpoint, terms it already has are not looked up again and
+    each batch is saved to it as soon as it's done.
+    """
+    terms = list(terms)
+    geoids = {}
+    if checkpoint:
+        geoids = checkpoint.lookups(mancer.machine_name)
+        progress.advance('geos_resolved', len([t for t in terms if t in geoids]))
+    todo = [t for t in terms if t not in geoids]
+
+    threads = min(mancer.lookup_concurrency, len(todo))
+    # Small enough that every thread gets a batch
+    size = int(math.ceil(len(todo) / float(max(threads, 1))))
+    size = max(1, min(LOOKUP_BATCH_SIZE, size))
+    batches = [todo[i:i + size] for i in xrange(0, len(todo), size)]
+
+    def lookup(batch):
+        cancellation.current.check()
+        found = mancer.geo_lookup_many(batch, geo_type=geo_type)
+        progress.advance('geos_resolved', len(batch))
+        return found
+
+    pool = None
+    if threads <= 1:
+        results = (lookup(batch) for batch in batches)
     else:
-        writeCSV(fpath, output)
-    response['download_url'] = '/download/%s' % fname
-    response['num_matches'] = response['num_rows'] - response['num_missing']
-    response['cols_added'] = list(set(header_row) - set(response['cols_added']))
-    return response
+        pool = ThreadPool(threads)
+        results = pool.imap(lookup, batches)
+    try:
+        for batch, found in izip(batches, results):
+            for term in batch:
+                geoids[term] = found.get(term)
+                if checkpoint:
+                    checkpoint.save_lookup(mancer.machine_name, term, geoids[term])
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return OrderedDict((term, geoids[term]) for term in terms)
 
-def writeXLS(fpath, output):
-    with open(fpath, 'wb') as f:
-        workbook = xlwt.Workbook(encoding='utf-8')
-        sheet = workbook.add_sheet('Geomancer Output')
-        for r, row in enumerate(output):
-            if row:
-                for c, col in enumerate(output[0]):
-                    sheet.write(r, c, row[c])
-        workbook.save(fpath)
-
-def writeXLSX(fpath, output):
-    with open(fpath, 'wb') as f:
-        workbook = Workbook()
-        sheet = workbook.active
-        sheet.title = 'Geomancer Output'
-        numcols = len(output[0])
-        for r, row in enumerate(output):
-            if row:
-                sheet.append([row[col_idx] for col_idx in range(numcols)])
-        workbook.save(fpath)
-
-def writeCSV(fpath, output):
+def writeXLS(fpath, rows):
+    """
+    Write rows (header first) to an .xls file. When a sheet reaches the
+    format's row limit the rest carry on onto a new sheet, with the header
+    repeated at the top. Rows are serialised as they go so xlwt doesn't
+    keep the whole spreadsheet around until it's saved.
+    """
+    workbook = xlwt.Workbook(encoding='utf-8')
+    rows = iter(rows)
+    header = rows.next()
+
+    def add_sheet(number):
+        name = 'Geomancer Output'
+        if number > 1:
+            name = '%s %s' % (name, number)
+        sheet = workbook.add_sheet(name)
+        write_xls_row(sheet.row(0), header)
+        return sheet
+
+    sheets = 1
+    sheet = add_sheet(sheets)
+    r = 1
+    for row in rows:
+        if r == XLS_MAX_ROWS:
+            sheet.flush_row_data()
+            sheets += 1
+            sheet = add_sheet(sheets)
+            r = 1
+        write_xls_row(sheet.row(r), row)
+        r += 1
+        if r % XLS_FLUSH_ROWS == 0:
+            sheet.flush_row_data()
+    workbook.save(fpath)
+
+def write_xls_row(xls_row, row):
+    for c, val in enumerate(row):
+        if val != '':
+            xls_row.write(c, val)
+
+def writeXLSX(fpath, rows):
+    # Write-only mode streams rows to a temp file instead of building every
+    # cell in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title='Geomancer Output')
+    for row in rows:
+        sheet.append(row)
+    workbook.save(fpath)
+
+def writeCSV(fpath, rows):
     with open(fpath, 'wb') as f:
         writer = UnicodeCSVWriter(f)
-        writer.writerows(output)
+        writer.writerows(rows)
+
+def worker_keys(config, worker_id):
+    """
+    Redis keys for a worker's processing list (the job it has taken off a
+    queue but not finished) and its heartbeat.
+    """
+    qkey = config['REDIS_QUEUE_KEY']
+    return '%s:processing:%s' % (qkey, worker_id), \
+        '%s:heartbeat:%s' % (qkey, worker_id)
+
+def pop_job(keys, processing, legacy=None):
+    """
+    Move the oldest job from the first non-empty queue in 'keys' onto the
+    worker's processing list, so it isn't lost if the worker dies while it
+    runs. Blocks on the first queue for up to POLL_TIMEOUT seconds if
+    they're all empty. Returns (queue, payload) or None.
+
+    Older web apps RPUSH onto the 'legacy' queue, so its oldest job is at
+    the left hand end rather than the right.
+    """
+    for queue in keys:
+        if queue == legacy:
+            payload = lpoplpush(keys=[queue, processing])
+        else:
+            payload = redis.rpoplpush(queue, processing)
+        if payload is not None:
+            return queue, payload
+    payload = redis.brpoplpush(keys[0], processing, timeout=POLL_TIMEOUT)
+    if payload is None:
+        return None
+    return keys[0], payload
+
+def beat(heartbeat):
+    redis.set(heartbeat, time.time())
+    redis.expire(heartbeat, HEARTBEAT_TTL)
+
+def send_heartbeats(heartbeat, stopped):
+    """
+    Runs in a thread of its own so the heartbeat keeps going during long jobs.
+    """
+    while not stopped.wait(HEARTBEAT_INTERVAL):
+        beat(heartbeat)
+
+def peek_job(payload):
+    """
+    The job's result key and queue, without decoding the rest of it. Raises
+    LegacyPayload for a pickle unless ACCEPT_LEGACY_PICKLE.
+    """
+    if not payload.startswith('{'):
+        if not ACCEPT_LEGACY_PICKLE:
+            raise LegacyPayload('Refused a job that is not JSON')
+        return loads(payload)[1], None
+    job = json.loads(payload)
+    return job['key'], job.get('queue')
+
+def reap_dead_workers(config, rv_ttl=500):
+    """
+    Find workers whose heartbeat has expired and put the jobs they were
+    working on back on their queues. A job that has already killed
+    JOB_MAX_ATTEMPTS workers goes on the dead letter list instead and the
+    client gets an error rather than waiting on it forever. Returns the
+    number of jobs recovered.
+    """
+    qkey = config['REDIS_QUEUE_KEY']
+    lock = '%s:reaper' % qkey
+    token = uuid4().hex
+    # One reaper at a time. The lock expires in case this one dies.
+    if not redis.set(lock, token, nx=True, ex=REAP_INTERVAL):
+        return 0
+    max_attempts = config.get('JOB_MAX_ATTEMPTS', JOB_MAX_ATTEMPTS)
+    attempts = '%s:attempts' % qkey
+    count = 0
+    try:
+        for worker_id in list(redis.smembers('%s:workers' % qkey)):
+            processing, heartbeat = worker_keys(config, worker_id)
+            if redis.exists(heartbeat):
+                continue
+            while True:
+                payload = redis.lindex(processing, -1)
+                if payload is None:
+                    break
+                try:
+                    key, queue = peek_job(payload)
+                except LegacyPayload, e:
+                    redis.rpoplpush(processing, '%s:dead' % qkey)
+                    print '%s, moved it to the dead letter list' % e.message
+                    count += 1
+                    continue
+                digest = sha1(payload).hexdigest()
+                if redis.hincrby(attempts, digest, 1) >= max_attempts:
+                    redis.rpoplpush(processing, '%s:dead' % qkey)
+                    redis.hdel(attempts, digest)
+                    rv = {'status': 'error',
+                          'result': 'This job stopped its worker %s times and '
+                                    'was abandoned' % max_attempts}
+                    redis.set(key, encode_result(rv))
+                    redis.expire(key, rv_ttl)
+                    print 'Job %s moved to the dead letter list' % key
+                else:
+                    redis.rpoplpush(processing, queue or qkey)
+                    print 'Requeued job %s from dead worker %s' % (key, worker_id)
+                count += 1
+            redis.srem('%s:workers' % qkey, worker_id)
+    finally:
+        # Unless it expired and another reaper has it now
+        release_lock(keys=[lock], args=[token])
+    return count
 
 def queue_daemon(app, rv_ttl=500):
+    global progress
     print 'Mancing commencing...'
-    while 1:
-        msg = redis.blpop(app.config['REDIS_QUEUE_KEY'])
-        func, key, args, kwargs = loads(msg[1])
-        try:
-            rv = func(*args, **kwargs)
-            rv = {'status': 'ok', 'result': rv}
-        except Exception, e:
-            if client:
-                client.captureException()
-            tb = traceback.format_exc()
-            print tb
+    # SIGTERM only flags the loop so the job in hand finishes before we exit.
+    # Keep the blocking pop from being interrupted by the signal and poll
+    # with a timeout so the flag gets noticed while the queue is idle.
+    draining = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: draining.append(signum))
+    signal.siginterrupt(signal.SIGTERM, False)
+    last_prune = 0
+    queues = job_queues(app.config)
+    # Weighted round robin: each pass prefers the next queue in the
+    # schedule and falls through to the others (and to the plain queue key
+    # older web apps push onto) when it is empty.
+    schedule = cycle([q for q, weight in queues for i in range(weight)])
+    session_limit = app.config.get('SESSION_JOB_LIMIT', SESSION_JOB_LIMIT)
+    worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+    processing, heartbeat = worker_keys(app.config, worker_id)
+    attempts = '%s:attempts' % app.config['REDIS_QUEUE_KEY']
+    # Beat before registering so the reaper never sees us without one
+    beat(heartbeat)
+    stopped = Event()
+    beats = Thread(target=send_heartbeats, args=(heartbeat, stopped))
+    beats.daemon = True
+    beats.start()
+    redis.sadd('%s:workers' % app.config['REDIS_QUEUE_KEY'], worker_id)
+    last_reap = 0
+    # Set up the mancers and fetch their metadata once, before the first job
+    # rather than during it. If the APIs are down the first job tries again.
+    try:
+        mancer_registry.get()
+    except Exception, e:
+        print 'Could not load mancer metadata: %s' % e
+    try:
+        while not draining:
+            first = next(schedule)
+            keys = [first] + [q for q, weight in queues if q != first] + \
+                [app.config['REDIS_QUEUE_KEY']]
+            if time.time() - last_reap > REAP_INTERVAL:
+                reap_dead_workers(app.config, rv_ttl=rv_ttl)
+                last_reap = time.time()
+            msg = pop_job(keys, processing, legacy=app.config['REDIS_QUEUE_KEY'])
+            if msg is None:
+                write_textfile()
+                if time.time() - last_prune > PRUNE_INTERVAL:
+                    prune()
+                    prune_checkpoints()
+                    prune_textfiles()
+                    last_prune = time.time()
+                continue
             try:
-                if e.body:
-                    rv = {'status': 'error', 'result': '{0} message: {1}'.format(e.message, e.body)}
-                else:
-                    rv = {'status': 'error', 'result': e.message}
-            except AttributeError:
-                rv = {'status': 'error', 'result': 'Error: {0}'.format(e.message)}
-        if rv is not None:
-            redis.set(key, dumps(rv))
-            redis.expire(key, rv_ttl)
+                job = decode_job(msg[1])
+            except UnknownJobVersion, e:
+                # Queued by a newer web app; leave it for an upgraded worker
+                print e.message
+                redis.rpoplpush(processing, msg[0])
+                time.sleep(POLL_TIMEOUT)
+                continue
+            except LegacyPayload, e:
+                # Nothing to tell anyone: there's no result key without
+                # unpickling it
+                print '%s, moved it to the dead letter list' % e.message
+                redis.rpoplpush(processing, '%s:dead' % app.config['REDIS_QUEUE_KEY'])
+                continue
+            running_key = None
+            if job.get('session') and session_limit:
+                running_key = '%s:running:%s' % (app.config['REDIS_QUEUE_KEY'],
+                                                 job['session'])
+                if redis.incr(running_key) > session_limit:
+                    # This session already has its share of workers, put the job
+                    # back at the end of its queue for later
+                    redis.decr(running_key)
+                    redis.rpoplpush(processing, msg[0])
+                    time.sleep(DEFER_DELAY)
+                    continue
+                redis.expire(running_key, RUNNING_TTL)
+            key = job['key']
+            if job.get('enqueued'):
+                QUEUE_WAIT_SECONDS.observe(time.time() - job['enqueued'],
+                                           queue=msg[0])
+            progress = JobProgress(redis, key)
+            started = time.time()
+            if job.get('time_limit'):
+                deadline = started + job['time_limit']
+            else:
+                # Queued with a fixed deadline before jobs carried a limit
+                deadline = job.get('deadline')
+            cancellation.current = JobControl(redis, key, deadline)
+            try:
+                # It may have been cancelled while queued
+                cancellation.current.check()
+                rv = job['func'](*job['args'], **job['kwargs'])
+                rv = {'status': 'ok', 'result': rv}
+            except JobCancelled, e:
+                print 'Job %s stopped: %s' % (key, e.message)
+                rv = {'status': 'cancelled', 'result': e.message}
+            except Exception, e:
+                if client:
+                    client.captureException()
+                tb = traceback.format_exc()
+                print tb
+                try:
+                    if e.body:
+                        rv = {'status': 'error', 'result': '{0} message: {1}'.format(e.message, e.body)}
+                    else:
+                        rv = {'status': 'error', 'result': e.message}
+                except AttributeError:
+                    rv = {'status': 'error', 'result': 'Error: {0}'.format(e.message)}
+            if running_key:
+                redis.decr(running_key)
+            if rv is not None:
+                redis.set(key, encode_result(rv))
+                redis.expire(key, rv_ttl)
+            redis.delete(processing)
+            redis.hdel(attempts, sha1(msg[1]).hexdigest())
+            progress.stage('done' if rv['status'] == 'ok' else rv['status'])
+            progress = JobProgress()
+            cancellation.current = JobControl()
+            redis.delete(cancel_key(key))
+            JOBS.inc(task=job['task'], status=rv['status'])
+            JOB_SECONDS.observe(time.time() - started, task=job['task'])
+            write_textfile()
+    finally:
+        # However the worker stops, its metrics stop being current
+        remove_textfile()
+    stopped.set()
+    redis.srem('%s:workers' % app.config['REDIS_QUEUE_KEY'], worker_id)
+    redis.delete(heartbeat)
+    print 'Worker %s drained, exiting' % os.getpid()
+
+def queue_daemon_pool(app, processes=2, rv_ttl=500):
+    """
+    Prefork supervisor around queue_daemon. Starts 'processes' children that
+    each pull jobs off the queue, so one big spreadsheet no longer holds up
+    everyone else's jobs. Children that die are replaced. SIGTERM (or SIGINT)
+    is passed on to the children, which finish the job they are on and exit;
+    the supervisor returns once they are all gone.
+    """
+    children = set()
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # The supervisor handles Ctrl-C for the whole group
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                queue_daemon(app, rv_ttl=rv_ttl)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print 'Starting %s mancers...' % processes
+    for i in range(processes):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        children.discard(pid)
+        # It may have been killed before it could remove its own
+        remove_textfile(pid=pid)
+        if not stopping:
+            print 'Worker %s exited with status %s, restarting' % (pid, status)
+            # Don't spin if children are dying on startup
+            time.sleep(RESPAWN_DELAY)
+            if not stopping:
+                spawn()
+    print 'All workers drained'
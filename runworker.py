@@ -1,6 +1,18 @@
-from geomancer.worker import queue_daemon
+from geomancer.worker import queue_daemon, queue_daemon_pool
 from geomancer import create_app
 
 app = create_app()
 
-queue_daemon(app)
+if __name__ == "__main__":
+    import sys
+    try:
+        processes = int(sys.argv[1])
+    except IndexError:
+        processes = app.config.get('WORKER_PROCESSES', 1)
+    except ValueError:
+        print 'Usage: python runworker.py [number of worker processes]'
+        sys.exit(1)
+    if processes > 1:
+        queue_daemon_pool(app, processes=processes)
+    else:
+        queue_daemon(app)